@@ -0,0 +1,203 @@
+"""
+In-memory static asset serving with precompression and strong ETags.
+
+Every file under the static directory is read once at startup, hashed and
+compressed (gzip, plus brotli when the package is installed). Responses come
+straight from memory in the best encoding the client accepts, with a strong
+ETag per encoding, so a reload answers If-None-Match with 304 Not Modified.
+Each asset is also reachable under a fingerprinted name (styles.1a2b3c4d.css)
+that is served with a year-long immutable Cache-Control; plain names use
+no-cache, i.e. always revalidate.
+
+Run `python assets.py` for a requests/second benchmark against FileResponse.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path, PurePosixPath
+from typing import Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Preferred first when the client accepts several
+_ENCODINGS = ("br", "gzip")
+
+
+class Asset:
+    """One static file with its precompressed variants."""
+
+    def __init__(self, name: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = PurePosixPath(name)
+        self.name = name
+        self.fingerprinted = str(path.with_name(f"{path.stem}.{digest[:8]}{path.suffix}"))
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type in ("application/javascript", "application/json"):
+            media_type += "; charset=utf-8"
+        self.media_type = media_type
+        self.tag = digest[:16]
+        self.variants = {"identity": data}
+        compressed = {"gzip": gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(data, quality=11)
+        for encoding, body in compressed.items():
+            if len(body) < len(data):
+                self.variants[encoding] = body
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.tag}"' if encoding == "identity" else f'"{self.tag}-{encoding}"'
+
+    def matches(self, if_none_match: str) -> bool:
+        """True if an If-None-Match header names any representation of this asset."""
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag.strip('"').split("-")[0] == self.tag:
+                return True
+        return False
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class AssetStore:
+    """All files under a directory, served from memory."""
+
+    def __init__(self, directory: Path):
+        self._assets = {}
+        self._fingerprinted = {}
+        for path in sorted(Path(directory).rglob("*")):
+            if path.is_file():
+                asset = Asset(path.relative_to(directory).as_posix(), path.read_bytes())
+                self._assets[asset.name] = asset
+                self._fingerprinted[asset.fingerprinted] = asset
+
+    def url(self, name: str, prefix: str = "/static") -> str:
+        """Fingerprinted URL of an asset, for long-lived caching."""
+        return f"{prefix}/{self._assets[name].fingerprinted}"
+
+    def get(self, name: str) -> tuple:
+        """Return (asset, immutable) for a plain or fingerprinted name, or (None, False)."""
+        asset = self._fingerprinted.get(name)
+        if asset is not None:
+            return asset, True
+        return self._assets.get(name), False
+
+    def response(self, request: Request, name: str, cache_control: Optional[str] = None) -> Response:
+        asset, immutable = self.get(name)
+        if asset is None:
+            return Response(status_code=404)
+        if cache_control is None:
+            cache_control = IMMUTABLE if immutable else REVALIDATE
+
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next((e for e in _ENCODINGS if e in accepted and e in asset.variants), "identity")
+        headers = {
+            "ETag": asset.etag(encoding),
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and asset.matches(if_none_match):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+
+def _benchmark(requests: int = 5000):
+    """Requests/second for FileResponse versus the in-memory store, in process."""
+    import asyncio
+    import time
+
+    from starlette.applications import Starlette
+    from starlette.responses import FileResponse
+    from starlette.routing import Route
+
+    static_dir = Path(__file__).parent / "static"
+    store = AssetStore(static_dir)
+
+    async def file_page(request):
+        return FileResponse(static_dir / "index.html")
+
+    async def store_page(request):
+        return store.response(request, "index.html")
+
+    apps = {
+        "FileResponse": Starlette(routes=[Route("/", file_page)]),
+        "AssetStore": Starlette(routes=[Route("/", store_page)]),
+    }
+
+    async def drive(app, headers: list) -> tuple:
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.4"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/",
+            "raw_path": b"/",
+            "root_path": "",
+            "query_string": b"",
+            "headers": headers,
+            "client": ("127.0.0.1", 1),
+            "server": ("127.0.0.1", 80),
+        }
+        sent = 0
+        status = None
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            await app(dict(scope), receive, send)
+        return requests / (time.perf_counter() - start), sent // requests, status
+
+    etag = store.get("index.html")[0].etag("gzip").encode()
+    cases = (
+        ("plain", [(b"accept-encoding", b"identity")]),
+        ("gzip", [(b"accept-encoding", b"gzip, deflate, br")]),
+        ("revalidate", [(b"accept-encoding", b"gzip, deflate, br"), (b"if-none-match", etag)]),
+    )
+    print(f"index.html, {requests} requests per case, brotli {'on' if brotli else 'off'}")
+    for name, app in apps.items():
+        for case, headers in cases:
+            rate, size, status = asyncio.run(drive(app, headers))
+            print(f"{name:>12} {case:>10}: {rate:>9,.0f} req/s, {size:>6} bytes, HTTP {status}")
+
+
+if __name__ == "__main__":
+    _benchmark()
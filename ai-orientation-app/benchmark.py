@@ -0,0 +1,474 @@
+"""
+Load generator and benchmark for the chat endpoints.
+
+Replays a concurrent workload against a running ai-orientation-app (backed by
+real models or a local stub) and reports throughput, TTFT and end-to-end
+latency percentiles and error rates as JSON, so runs can be diffed:
+
+    python benchmark.py --url http://localhost:8000 --mix chat=3,tokenize=1 \\
+        --concurrency 16 --requests 200 --prompt-words 20:400 --max-tokens 32:256 \\
+        --output run.json
+    python benchmark.py --url http://localhost:8000 --baseline run.json
+
+Each simulated user sends its own X-Forwarded-For address, so the app must
+run with PROXY_COUNT=1 to queue them as separate students (--stub does this).
+With --stub the app and a stub model server (stub_server.py) are started as
+local subprocesses first, so the proxy itself can be measured offline:
+
+    python benchmark.py --stub --stub-args "--token-rate 100 --ttft 0.05"
+
+With --check-disconnects N it instead opens N chat and N compare streams,
+hangs up after the first content and checks at the stubs that every upstream
+generation was cancelled rather than left running to max_tokens.
+
+Workloads: chat (/api/chat), playground (/api/chat/playground), compare
+(/api/chat/compare) and tokenize (/api/tokenize). Chat-style workloads stream;
+TTFT is the time until the first content arrives at the client.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import asyncio
+import argparse
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Optional
+
+import httpx
+
+WORKLOADS = ("chat", "playground", "compare", "tokenize")
+
+_VOCABULARY = (
+    "model serving latency token throughput cluster replica prompt cache "
+    "quantized weights batch request stream kernel memory gpu cpu context "
+    "explain describe summarize compare the a of and to in for with on"
+).split()
+
+
+def parse_range(value: str) -> tuple:
+    """Parse "N" or "MIN:MAX" into an inclusive (min, max) pair."""
+    low, _, high = value.partition(":")
+    low = int(low)
+    high = int(high) if high else low
+    if low < 1 or high < low:
+        raise argparse.ArgumentTypeError(f"invalid range: {value}")
+    return low, high
+
+
+def parse_mix(value: str) -> dict:
+    """Parse "chat=3,tokenize=1" into workload weights."""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in WORKLOADS:
+            raise argparse.ArgumentTypeError(f"unknown workload: {name}")
+        mix[name] = float(weight) if weight else 1.0
+    return mix
+
+
+def percentile(values: list, pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Result:
+    """Outcome of one request."""
+
+    def __init__(self, workload: str):
+        self.workload = workload
+        self.started = time.perf_counter()
+        self.ttft: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.tokens = 0
+        self.status: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def first_content(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def done(self):
+        self.latency = time.perf_counter() - self.started
+
+
+class Workload:
+    """Builds random requests for the configured distributions."""
+
+    def __init__(self, prompt_words: tuple, max_tokens: tuple, temperature: float, seed: Optional[int]):
+        self.prompt_words = prompt_words
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.rng = random.Random(seed)
+
+    def prompt(self) -> str:
+        words = self.rng.randint(*self.prompt_words)
+        return " ".join(self.rng.choice(_VOCABULARY) for _ in range(words))
+
+    def request(self, workload: str) -> tuple:
+        """Return (path, json body) for one request of the given workload."""
+        max_tokens = self.rng.randint(*self.max_tokens)
+        if workload == "chat":
+            return "/api/chat", {
+                "message": self.prompt(),
+                "temperature": self.temperature,
+                "max_tokens": max_tokens,
+            }
+        if workload == "playground":
+            return "/api/chat/playground", {
+                "user_prompt": self.prompt(),
+                "temperature": self.temperature,
+                "max_tokens": max_tokens,
+            }
+        if workload == "compare":
+            return "/api/chat/compare", {
+                "prompt": self.prompt(),
+                "temperature": self.temperature,
+                "max_tokens": max_tokens,
+            }
+        return "/api/tokenize", {"text": self.prompt()}
+
+
+async def run_request(client: httpx.AsyncClient, workload: str, path: str, body: dict, headers: dict = None) -> Result:
+    result = Result(workload)
+    try:
+        if workload == "tokenize":
+            response = await client.post(path, json=body, headers=headers)
+            result.status = response.status_code
+            if response.status_code == 200:
+                result.tokens = response.json().get("count", 0)
+            else:
+                result.error = f"HTTP {response.status_code}"
+            result.done()
+            return result
+
+        async with client.stream("POST", path, json=body, headers=headers) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                result.error = f"HTTP {response.status_code}"
+                result.done()
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if event.get("error"):
+                    # Compare events flag errors and carry the message as content
+                    result.error = str(event["content"] if workload == "compare" else event["error"])
+                elif event.get("content") or event.get("delta"):
+                    result.first_content()
+                if "metrics" in event and event["metrics"]:
+                    # The final event reports the upstream token count
+                    result.tokens += event["metrics"].get("tokens") or 0
+        result.done()
+    except httpx.TimeoutException:
+        result.error = "timeout"
+        result.done()
+    except httpx.RequestError as e:
+        result.error = type(e).__name__
+        result.done()
+    return result
+
+
+async def run_benchmark(
+    url: str,
+    mix: dict,
+    concurrency: int,
+    requests: int,
+    duration: Optional[float],
+    workload: Workload,
+    timeout: float = 120.0,
+) -> dict:
+    """Run the workload with `concurrency` closed-loop clients and return a report."""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = []
+    issued = 0
+    deadline = time.perf_counter() + duration if duration else None
+
+    def next_request():
+        nonlocal issued
+        if deadline is not None:
+            if time.perf_counter() >= deadline:
+                return None
+        elif issued >= requests:
+            return None
+        issued += 1
+        name = workload.rng.choices(names, weights)[0]
+        return (name,) + workload.request(name)
+
+    async def client_loop(client, index):
+        # Each simulated user gets its own address so the app's per-client
+        # fair queuing treats them as separate students; the benchmark stands
+        # in for the one proxy the app trusts (PROXY_COUNT=1)
+        headers = {"X-Forwarded-For": f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"}
+        while True:
+            item = next_request()
+            if item is None:
+                return
+            results.append(await run_request(client, *item, headers=headers))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    report = {
+        "config": {
+            "url": url,
+            "mix": mix,
+            "concurrency": concurrency,
+            "requests": requests if deadline is None else None,
+            "duration": duration,
+            "prompt_words": list(workload.prompt_words),
+            "max_tokens": list(workload.max_tokens),
+        },
+        "elapsed": elapsed,
+        "overall": summarize(results, elapsed),
+        "workloads": {
+            name: summarize([r for r in results if r.workload == name], elapsed) for name in names
+        },
+    }
+    return report
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    ok = [r for r in results if r.error is None]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    latencies = [r.latency for r in ok]
+    errors = {}
+    for r in results:
+        if r.error is not None:
+            key = r.error if len(r.error) <= 80 else r.error[:77] + "..."
+            errors[key] = errors.get(key, 0) + 1
+    tokens = sum(r.tokens for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": errors,
+        "requests_per_second": len(ok) / elapsed if elapsed > 0 else None,
+        "tokens_per_second": tokens / elapsed if elapsed > 0 else None,
+        "ttft": {f"p{p}": percentile(ttfts, p) for p in (50, 90, 99)},
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 90, 99)},
+    }
+
+
+# Metrics compared against a baseline, and whether higher is better
+_COMPARED = (
+    ("requests_per_second", True),
+    ("tokens_per_second", True),
+    ("error_rate", False),
+    ("ttft.p50", False),
+    ("ttft.p99", False),
+    ("latency.p50", False),
+    ("latency.p99", False),
+)
+
+
+def _lookup(summary: dict, key: str):
+    for part in key.split("."):
+        summary = (summary or {}).get(part)
+    return summary
+
+
+def compare_reports(baseline: dict, current: dict) -> dict:
+    """Relative change of the headline metrics per workload (positive = better)."""
+    comparison = {}
+    for section in ["overall"] + sorted(current.get("workloads", {})):
+        before = baseline["overall"] if section == "overall" else baseline.get("workloads", {}).get(section)
+        after = current["overall"] if section == "overall" else current["workloads"][section]
+        if before is None:
+            continue
+        changes = {}
+        for key, higher_is_better in _COMPARED:
+            old, new = _lookup(before, key), _lookup(after, key)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            changes[key] = {
+                "baseline": old,
+                "current": new,
+                "improvement": change if higher_is_better else -change,
+            }
+        comparison[section] = changes
+    return comparison
+
+
+async def _stub_totals(client: httpx.AsyncClient, stub_urls: list) -> dict:
+    totals = {}
+    for stub_url in stub_urls:
+        stats = (await client.get(f"{stub_url}/stub/stats")).json()
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+async def check_disconnects(url: str, stub_urls: list, count: int, workload: Workload, timeout: float = 120.0) -> dict:
+    """
+    Abandon `count` chat and compare streams after their first content and
+    report how the stubs' generations ended. Every generation the clients
+    abandoned must show up as cancelled at the stub, and the app must still
+    serve a request afterwards (leaked upstream connections exhaust its pool).
+    """
+    async with httpx.AsyncClient(timeout=timeout) as stubs, \
+            httpx.AsyncClient(base_url=url, timeout=timeout) as client:
+        before = await _stub_totals(stubs, stub_urls)
+        for index in range(count):
+            for name in ("chat", "compare"):
+                path, body = workload.request(name)
+                headers = {"X-Forwarded-For": f"10.255.{index // 256 % 256}.{index % 256}"}
+                async with client.stream("POST", path, json=body, headers=headers) as response:
+                    async for line in response.aiter_lines():
+                        if '"content"' in line or '"delta"' in line:
+                            # Leaving the block closes the connection mid-stream
+                            break
+
+        # Cancellation is asynchronous; give the app a moment to close its upstreams
+        deadline = time.monotonic() + 10.0
+        while True:
+            after = await _stub_totals(stubs, stub_urls)
+            delta = {key: after[key] - before.get(key, 0) for key in after}
+            running = delta["started"] - delta["completed"] - delta["cancelled"] - delta["aborted"]
+            if running <= 0 or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.2)
+
+        follow_up = await run_request(client, "chat", *workload.request("chat"))
+
+    return {
+        "streams_abandoned": 2 * count,
+        "upstream_generations": delta["started"],
+        "cancelled": delta["cancelled"],
+        "completed": delta["completed"],
+        "still_running": running,
+        "follow_up_error": follow_up.error,
+        "ok": delta["cancelled"] > 0 and running <= 0 and follow_up.error is None,
+    }
+
+
+def _wait_healthy(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.RequestError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become healthy within {timeout:.0f}s")
+
+
+@contextmanager
+def local_stack(stub_args: list, app_port: int = 8600, stub_port: int = 8601):
+    """
+    Run the app and one stub model server per configured model as subprocesses.
+
+    Each model gets its own stub (and so its own scheduler and replica pool in
+    the app), just like separate model deployments. Yields the app URL and the
+    stub URLs.
+    """
+    here = Path(__file__).parent
+    env = dict(os.environ, PROXY_COUNT="1")
+    for offset, variable in enumerate(("MODEL_URL", "COMPRESSED_MODEL_URL", "TINY_URL")):
+        env[variable] = f"http://127.0.0.1:{stub_port + offset}"
+    app_url = f"http://127.0.0.1:{app_port}"
+    stub_urls = [f"http://127.0.0.1:{stub_port + offset}" for offset in range(3)]
+    processes = []
+    try:
+        for offset, stub_url in enumerate(stub_urls):
+            stub = subprocess.Popen(
+                [sys.executable, "stub_server.py", "--port", str(stub_port + offset)] + stub_args, cwd=here
+            )
+            processes.append(stub)
+            _wait_healthy(stub_url, stub)
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(app_port), "--log-level", "warning"],
+            cwd=here,
+            env=env,
+        )
+        processes.append(app)
+        _wait_healthy(app_url, app)
+        yield app_url, stub_urls
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="base URL of the app")
+    parser.add_argument("--mix", type=parse_mix, default={"chat": 1.0}, help="weighted workloads, e.g. chat=3,compare=1")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=100, help="total requests (ignored with --duration)")
+    parser.add_argument("--duration", type=float, default=None, help="run for this many seconds instead")
+    parser.add_argument("--prompt-words", type=parse_range, default=(20, 200), help="prompt length range in words")
+    parser.add_argument("--max-tokens", type=parse_range, default=(64, 256), help="max_tokens range")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=None, help="seed for reproducible request sequences")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="compare against a previous JSON report")
+    parser.add_argument("--stub", action="store_true", help="start the app and a stub model server locally")
+    parser.add_argument("--stub-args", default="", help="extra stub_server.py flags, e.g. \"--token-rate 100\"")
+    parser.add_argument(
+        "--check-disconnects", type=int, default=0, metavar="N",
+        help="with --stub, abandon N chat and N compare streams and check the upstreams were cancelled",
+    )
+    args = parser.parse_args(argv)
+    if args.check_disconnects and not args.stub:
+        parser.error("--check-disconnects needs --stub to read the stubs' generation counts")
+
+    workload = Workload(args.prompt_words, args.max_tokens, args.temperature, args.seed)
+
+    def run(url: str) -> dict:
+        return asyncio.run(run_benchmark(
+            url.rstrip("/"),
+            args.mix,
+            args.concurrency,
+            args.requests,
+            args.duration,
+            workload,
+            args.timeout,
+        ))
+
+    if args.check_disconnects:
+        with local_stack(shlex.split(args.stub_args)) as (url, stub_urls):
+            report = asyncio.run(check_disconnects(url, stub_urls, args.check_disconnects, workload, args.timeout))
+        print(json.dumps(report, indent=2))
+        return 0 if report["ok"] else 1
+
+    if args.stub:
+        with local_stack(shlex.split(args.stub_args)) as (url, _):
+            report = run(url)
+        report["config"]["stub_args"] = args.stub_args
+    else:
+        report = run(args.url)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare_reports(json.load(f), report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if report["overall"]["succeeded"] == 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
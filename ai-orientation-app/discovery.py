@@ -0,0 +1,111 @@
+"""
+Background model discovery and health probing.
+
+A single task probes every replica of the configured models on a fixed
+interval: first /v1/models (which also yields the served model ids and max
+context length), falling back to /health for servers without it. URLs that
+clients send are never probed, so the proxy can't be made to poll arbitrary
+hosts. Results are stored on the
+replica's Endpoint, so request handling only reads cached state: replicas
+that are down are skipped, a model whose replicas are all down is rejected
+immediately, and /config reports metadata without calling the models. The
+probes also keep a warm keep-alive connection to each replica, so the first
+request after startup doesn't pay connect and TLS setup.
+"""
+
+import asyncio
+import logging
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class ModelDiscovery:
+    """Periodically probes the replicas of the configured model pools in an UpstreamRegistry."""
+
+    def __init__(self, upstreams, interval: float = 15.0, timeout: float = 3.0):
+        self.upstreams = upstreams
+        self.interval = interval
+        self.timeout = timeout
+        self.last_probe: dict = {}
+        self._task = None
+
+    async def probe_endpoint(self, client: httpx.AsyncClient, endpoint):
+        """Probe one replica and record its health and model metadata."""
+        started = time.monotonic()
+        try:
+            response = await client.get(f"{endpoint.url}/v1/models", timeout=self.timeout)
+            if response.status_code == 200:
+                models = response.json().get("data", [])
+                endpoint.models = [model.get("id") for model in models]
+                lengths = [model["max_model_len"] for model in models if model.get("max_model_len")]
+                endpoint.max_model_len = min(lengths) if lengths else None
+            else:
+                response = await client.get(f"{endpoint.url}/health", timeout=self.timeout)
+            healthy = response.status_code == 200
+            error = None if healthy else f"HTTP {response.status_code}"
+        except httpx.TimeoutException:
+            healthy, error = False, f"no response within {self.timeout:g}s"
+        except (httpx.RequestError, ValueError) as e:
+            healthy, error = False, str(e) or type(e).__name__
+
+        if healthy != endpoint.healthy:
+            if healthy:
+                logger.info("Upstream %s is up", endpoint.url)
+            else:
+                logger.warning("Upstream %s is down: %s", endpoint.url, error)
+        endpoint.healthy = healthy
+        endpoint.probe_error = error
+        self.last_probe[endpoint.url] = {"at": time.time(), "latency": time.monotonic() - started}
+
+    async def probe_all(self, client: httpx.AsyncClient):
+        """Probe every replica of every configured model concurrently."""
+        endpoints = [endpoint for _, pool in self.upstreams.pools() for endpoint in pool.endpoints]
+        await asyncio.gather(*(self.probe_endpoint(client, endpoint) for endpoint in endpoints))
+
+    async def run(self, client: httpx.AsyncClient):
+        while True:
+            try:
+                await self.probe_all(client)
+            except Exception:
+                logger.exception("Model discovery round failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self, client: httpx.AsyncClient):
+        self._task = asyncio.create_task(self.run(client))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def snapshot(self) -> dict:
+        """Cached status and metadata per model URL setting."""
+        result = {}
+        for key, pool in self.upstreams.pools():
+            states = [endpoint.healthy for endpoint in pool.endpoints]
+            if any(states):
+                status = "up"
+            elif all(state is False for state in states):
+                status = "down"
+            else:
+                status = "unknown"
+            lengths = [endpoint.max_model_len for endpoint in pool.endpoints if endpoint.max_model_len]
+            result[key] = {
+                "status": status,
+                "models": sorted({model for endpoint in pool.endpoints for model in endpoint.models if model}),
+                "max_model_len": min(lengths) if lengths else None,
+                "replicas": [
+                    {
+                        "url": endpoint.url,
+                        "healthy": endpoint.healthy,
+                        "error": endpoint.probe_error,
+                        **self.last_probe.get(endpoint.url, {}),
+                    }
+                    for endpoint in pool.endpoints
+                ],
+            }
+        return result
@@ -1,21 +1,34 @@
 import os
-import json
 import time
+import logging
 import asyncio
+import itertools
 from pathlib import Path
-from typing import Optional
-from contextlib import asynccontextmanager
+from typing import Annotated, List, Optional
+from contextlib import aclosing, asynccontextmanager
 
 import httpx
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
+from assets import AssetStore
+from discovery import ModelDiscovery
+from prefixes import PrefixTracker, normalize_prompt, prefix_fingerprint
+from relay import DONE_EVENT, encode_event, relay_content
+from scheduler import ModelScheduler, QueueFull, SchedulerRegistry
+from sessions import SessionStore
+from shared import WorkerMetrics, open_store
+from streams import ClientDisconnected, call_until_disconnect, cancel_on_disconnect, merge_streams
+from telemetry import CANCELLED_GENERATIONS, TOKENS_SAVED, GenerationTimer, record_cancellation, register_models, registry
+from tracing import TracingMiddleware, UpstreamSpan, setup_tracing, shutdown_tracing
+from upstreams import UpstreamRegistry
+
 # Static files directory
 STATIC_DIR = Path(__file__).parent / "static"
 
-# Configuration from environment
+# Configuration from environment. Model URLs may list several comma-separated
+# replicas, which are load balanced per request.
 DEFAULT_MODEL_URL = os.getenv("MODEL_URL", "http://localhost:8080")
 DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "gpt-3.5-turbo")
 TINY_MODEL_URL = os.getenv("TINY_URL", "https://tinyllama-1b-cpu")
@@ -23,6 +36,63 @@ TINY_MODEL_NAME = os.getenv("TINY_MODEL_NAME", "tinyllama")
 COMPRESSED_MODEL_URL = os.getenv("COMPRESSED_MODEL_URL", "http://localhost:8081")
 COMPRESSED_MODEL_NAME = os.getenv("COMPRESSED_MODEL_NAME", "llama32-fp8")
 
+# Admission control: concurrent upstream requests per model and wait queue bounds
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "8"))
+TINY_MAX_CONCURRENT_REQUESTS = int(os.getenv("TINY_MAX_CONCURRENT_REQUESTS", "2"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "64"))
+MAX_QUEUED_PER_CLIENT = int(os.getenv("MAX_QUEUED_PER_CLIENT", "2"))
+# Model URLs sent by clients (playground, compare, batch) that keep a scheduler
+# and replica pool at once; idle ones are forgotten least recently used first
+MAX_CUSTOM_MODELS = int(os.getenv("MAX_CUSTOM_MODELS", "16"))
+# Reverse proxies in front of the app (1 behind the OpenShift router) whose
+# X-Forwarded-For entries are trusted to identify the client; 0 ignores the header
+PROXY_COUNT = int(os.getenv("PROXY_COUNT", "0"))
+
+# Replica selection ("least_outstanding" or "p2c") and passive health ejection
+UPSTREAM_STRATEGY = os.getenv("UPSTREAM_STRATEGY", "least_outstanding")
+UPSTREAM_EJECT_AFTER_FAILURES = int(os.getenv("UPSTREAM_EJECT_AFTER_FAILURES", "3"))
+UPSTREAM_EJECT_SECONDS = float(os.getenv("UPSTREAM_EJECT_SECONDS", "30"))
+
+# Background health probes of every upstream replica (/v1/models, /health).
+# Probing more often than the keep-alive expiry keeps connections warm.
+MODEL_PROBE_INTERVAL = float(os.getenv("MODEL_PROBE_INTERVAL", "15"))
+MODEL_PROBE_TIMEOUT = float(os.getenv("MODEL_PROBE_TIMEOUT", "3"))
+KEEPALIVE_EXPIRY = float(os.getenv("KEEPALIVE_EXPIRY", "60"))
+
+# Playground requests sharing a system prompt stick to one replica (for vLLM
+# prefix cache hits) unless it has this many more requests in flight than the
+# least busy one; reuse is estimated over the last N prompts per replica
+PREFIX_AFFINITY_SLACK = int(os.getenv("PREFIX_AFFINITY_SLACK", "2"))
+PREFIX_CACHE_ENTRIES = int(os.getenv("PREFIX_CACHE_ENTRIES", "64"))
+
+# SSE relay: deltas that arrive together always share a frame; a window > 0 also
+# holds them back for up to that many milliseconds or SSE_BATCH_MAX_CHARS
+SSE_BATCH_WINDOW_MS = float(os.getenv("SSE_BATCH_WINDOW_MS", "0"))
+SSE_BATCH_MAX_CHARS = int(os.getenv("SSE_BATCH_MAX_CHARS", "256"))
+
+# Upper bound on models in a single /api/chat/compare request
+MAX_COMPARE_MODELS = int(os.getenv("MAX_COMPARE_MODELS", "4"))
+
+# /api/chat/batch: largest prompt matrix accepted in one job
+MAX_BATCH_CELLS = int(os.getenv("MAX_BATCH_CELLS", "64"))
+
+# Server-side chat sessions: LRU bounds and the prompt + completion token budget
+# (further capped by the model's max_model_len when its tokenizer reports it)
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "100"))
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "4096"))
+
+# Ask upstreams for token usage at the end of a stream (stream_options.include_usage)
+STREAM_INCLUDE_USAGE = os.getenv("STREAM_INCLUDE_USAGE", "true").lower() == "true"
+
+# Worker processes (the variable uvicorn --workers and gunicorn -w default to)
+# and the store they share: "memory" or "sqlite:///<path>"; see shared.py
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STATE = os.getenv("SHARED_STATE", "memory")
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "5"))
+
+logger = logging.getLogger(__name__)
+
 
 # Pydantic models for request validation
 class ChatRequest(BaseModel):
@@ -30,6 +100,10 @@ class ChatRequest(BaseModel):
     temperature: float = Field(default=0.7, ge=0.0, le=1.0)
     max_tokens: int = Field(default=2048, ge=1, le=4096)
     stream: bool = True
+    passthrough: bool = False
+    # Continue a server-side conversation (ids come from POST /api/sessions);
+    # an unknown or expired id starts a new session, reported in the response
+    session_id: Optional[str] = Field(default=None, min_length=1, max_length=64)
 
 
 class PlaygroundRequest(BaseModel):
@@ -40,6 +114,23 @@ class PlaygroundRequest(BaseModel):
     temperature: float = Field(default=0.7, ge=0.0, le=2.0)
     max_tokens: int = Field(default=100, ge=1, le=4096)
     stream: bool = True
+    passthrough: bool = False
+
+
+class CompareModel(BaseModel):
+    name: Optional[str] = None
+    url: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    # Every combination of system prompt x user prompt x temperature x model is run
+    system_prompts: List[str] = Field(default=["You are a helpful assistant."], min_length=1)
+    user_prompts: List[str] = Field(min_length=1)
+    temperatures: List[Annotated[float, Field(ge=0.0, le=2.0)]] = Field(default=[0.7], min_length=1)
+    models: Optional[List[CompareModel]] = Field(default=None, min_length=1, max_length=MAX_COMPARE_MODELS)
+    max_tokens: int = Field(default=100, ge=1, le=4096)
+    # Cells in flight at once; capped so a batch never exceeds its per-client queue share
+    concurrency: int = Field(default=2, ge=1)
 
 
 class CompareRequest(BaseModel):
@@ -48,6 +139,8 @@ class CompareRequest(BaseModel):
     model_url_1: Optional[str] = None
     model_name_2: Optional[str] = None
     model_url_2: Optional[str] = None
+    # Compare any number of models instead of the two fixed slots
+    models: Optional[List[CompareModel]] = Field(default=None, min_length=1, max_length=MAX_COMPARE_MODELS)
     temperature: float = Field(default=0.7, ge=0.0, le=1.0)
     max_tokens: int = Field(default=512, ge=1, le=4096)
 
@@ -55,13 +148,63 @@ class CompareRequest(BaseModel):
 # HTTP client for making requests to LLM APIs
 http_client: httpx.AsyncClient = None
 
+# Sessions, per-client queue limits and metrics shared between workers
+state = open_store(SHARED_STATE)
+worker_metrics = WorkerMetrics(state, registry, METRICS_PUBLISH_INTERVAL)
+
+# One scheduler per upstream model, created on first use
+schedulers = SchedulerRegistry(
+    MAX_CONCURRENT_REQUESTS,
+    MAX_QUEUED_REQUESTS,
+    MAX_QUEUED_PER_CLIENT,
+    WORKERS,
+    state if state.shared else None,
+    MAX_CUSTOM_MODELS,
+)
+schedulers.configure(DEFAULT_MODEL_URL)
+schedulers.configure(COMPRESSED_MODEL_URL)
+schedulers.configure(TINY_MODEL_URL, TINY_MAX_CONCURRENT_REQUESTS)
+
+# Replica pools per model URL setting, created on first use
+upstreams = UpstreamRegistry(
+    UPSTREAM_STRATEGY, UPSTREAM_EJECT_AFTER_FAILURES, UPSTREAM_EJECT_SECONDS, PREFIX_AFFINITY_SLACK, MAX_CUSTOM_MODELS
+)
+
+# Metrics and prefix stats get a label per configured model; other names count as "custom"
+register_models(DEFAULT_MODEL_NAME, TINY_MODEL_NAME, COMPRESSED_MODEL_NAME)
+
+# System prompt fingerprints served by each replica
+prefix_tracker = PrefixTracker(PREFIX_CACHE_ENTRIES)
+
+# Cached health and metadata of the configured models
+discovery = ModelDiscovery(upstreams, MODEL_PROBE_INTERVAL, MODEL_PROBE_TIMEOUT)
+
+# Conversation histories for /api/chat and /api/chat/context
+sessions = SessionStore(state, MAX_SESSIONS, SESSION_MAX_MESSAGES)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global http_client
-    http_client = httpx.AsyncClient(timeout=60.0)
+    if WORKERS > 1 and not state.shared:
+        logger.warning(
+            "WEB_CONCURRENCY=%d with SHARED_STATE=memory: sessions and metrics are per worker; "
+            "set SHARED_STATE=sqlite:///<path> to share them", WORKERS)
+    http_client = httpx.AsyncClient(timeout=60.0, limits=httpx.Limits(keepalive_expiry=KEEPALIVE_EXPIRY))
+    # Register the configured models so the first probe round also opens
+    # their connections before any student request arrives
+    for model_url in (DEFAULT_MODEL_URL, TINY_MODEL_URL, COMPRESSED_MODEL_URL):
+        upstreams.configure(model_url)
+        # Created now so a cap the workers can't honour is reported at startup
+        get_scheduler(model_url)
+    discovery.start(http_client)
+    worker_metrics.start()
     yield
+    await worker_metrics.stop()
+    await discovery.stop()
     await http_client.aclose()
+    state.close()
+    shutdown_tracing()
 
 
 app = FastAPI(
@@ -71,8 +214,70 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
-# Mount static files
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+# Tracing is active only when OTEL_EXPORTER_OTLP_ENDPOINT is set
+setup_tracing("ai-orientation-app")
+app.add_middleware(TracingMiddleware)
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    # Nobody is listening any more; 499 mirrors the nginx convention in logs
+    return Response(status_code=499)
+
+
+# Static pages are precompressed and served from memory with ETags
+assets = AssetStore(STATIC_DIR)
+
+
+def get_client_id(request: Request) -> str:
+    """
+    Identify the caller for fair queuing.
+
+    Proxies append to X-Forwarded-For, so only the last PROXY_COUNT entries
+    were added by ours; anything before them came from the client and could
+    be changed on every request to dodge the per-client queue cap.
+    """
+    if PROXY_COUNT > 0:
+        hops = [hop.strip() for hop in ",".join(request.headers.getlist("x-forwarded-for")).split(",")]
+        if len(hops) >= PROXY_COUNT and hops[-PROXY_COUNT]:
+            return hops[-PROXY_COUNT]
+    return request.client.host if request.client else "unknown"
+
+
+def get_scheduler(model_url: str) -> ModelScheduler:
+    """Scheduler for a logical model, with its cap scaled by the replica count."""
+    return schedulers.get(model_url, replicas=len(upstreams.get(model_url).endpoints))
+
+
+async def check_admission(model_url: str, client_id: str):
+    """
+    Reject a request up front with 503 when the health probe reports the
+    model down, or with 429/503 when the model's queue is full.
+    """
+    pool = upstreams.get(model_url)
+    if pool.down():
+        reasons = "; ".join(sorted({ep.probe_error for ep in pool.endpoints if ep.probe_error}))
+        raise HTTPException(
+            status_code=503,
+            detail=f"The model is not responding ({reasons}). It may still be starting up; please try again shortly.",
+            headers={"Retry-After": str(int(MODEL_PROBE_INTERVAL))},
+        )
+    try:
+        await get_scheduler(model_url).check(client_id)
+    except QueueFull as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def record_upstream_status(lease, status_code: int):
+    """Count server errors against the replica; anything else means it is healthy."""
+    if status_code >= 500:
+        lease.failure()
+    else:
+        lease.success()
 
 
 async def stream_chat_response(
@@ -81,9 +286,21 @@ async def stream_chat_response(
     messages: list,
     temperature: float,
     max_tokens: int,
+    client_id: str = "unknown",
+    passthrough: bool = False,
+    reply: Optional[dict] = None,
+    prefix: Optional[str] = None,
 ):
-    """Stream response from an LLM API."""
-    url = f"{model_url.rstrip('/')}/v1/chat/completions"
+    """
+    Stream response from an LLM API.
+    Content deltas are re-framed as {"content": ...} events, batched per the
+    SSE_BATCH_* settings, and a final {"metrics": ...} event reports TTFT,
+    inter-token latency and tokens/sec. With passthrough=True the upstream
+    OpenAI chunks are forwarded byte for byte instead. If a `reply` dict is
+    given, the full reply text and its token count are stored in it once the
+    stream completes. `prefix` is a prompt prefix fingerprint used for
+    replica affinity.
+    """
     payload = {
         "model": model_name,
         "messages": messages,
@@ -91,33 +308,72 @@ async def stream_chat_response(
         "max_tokens": max_tokens,
         "stream": True,
     }
+    if STREAM_INCLUDE_USAGE and not passthrough:
+        payload["stream_options"] = {"include_usage": True}
 
     try:
-        async with http_client.stream("POST", url, json=payload) as response:
-            if response.status_code != 200:
-                error_text = await response.aread()
-                yield f"data: {json.dumps({'error': f'Error {response.status_code}: {error_text.decode()}'})}\n\n"
-                return
-
-            async for line in response.aiter_lines():
-                if not line or not line.startswith("data: "):
-                    continue
-                data = line[6:]  # Remove "data: " prefix
-                if data == "[DONE]":
-                    yield "data: [DONE]\n\n"
-                    break
-                try:
-                    chunk = json.loads(data)
-                    content = chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                    if content:
-                        yield f"data: {json.dumps({'content': content})}\n\n"
-                except json.JSONDecodeError:
-                    continue
-
+        ticket = await get_scheduler(model_url).enqueue(client_id)
+    except QueueFull as e:
+        yield encode_event({"error": str(e), "retry_after": e.retry_after})
+        return
+
+    timer = GenerationTimer(model_name)
+    span = UpstreamSpan(model_name)
+    usage = {}
+    try:
+        async for position in ticket.wait():
+            if not passthrough:
+                yield encode_event({"queue_position": position})
+
+        with upstreams.get(model_url).acquire(prefix) as lease:
+            if prefix:
+                prefix_tracker.record(model_name, lease.url, prefix)
+            url = f"{lease.url}/v1/chat/completions"
+            span.start(lease.url)
+            timer.start()
+            async with http_client.stream("POST", url, json=payload, headers=span.headers()) as response:
+                record_upstream_status(lease, response.status_code)
+                if response.status_code != 200:
+                    error_text = await response.aread()
+                    span.finish(timer.finish(response.status_code), error=f"HTTP {response.status_code}")
+                    yield encode_event({"error": f"Error {response.status_code}: {error_text.decode()}"})
+                    return
+
+                if passthrough:
+                    async for chunk in response.aiter_bytes():
+                        timer.tokens_received(chunk.count(b"data:") - chunk.count(b"[DONE]"))
+                        yield chunk
+                    span.finish(timer.finish(response.status_code))
+                    return
+
+                parts = []
+                async for content, count in relay_content(
+                    response.aiter_bytes(), SSE_BATCH_MAX_CHARS, SSE_BATCH_WINDOW_MS / 1000, usage
+                ):
+                    timer.tokens_received(count)
+                    parts.append(content)
+                    yield encode_event({"content": content})
+                metrics = timer.finish(response.status_code)
+                span.finish(metrics, usage)
+                if reply is not None:
+                    reply["content"] = "".join(parts)
+                    reply["tokens"] = usage.get("completion_tokens", timer.tokens)
+                yield encode_event({"metrics": metrics})
+                yield DONE_EVENT
+
+    except asyncio.CancelledError:
+        if timer.started is not None and timer.status is None:
+            span.finish(timer.finish("cancelled"), usage, cancelled=True)
+            record_cancellation(model_name, max_tokens, timer.tokens)
+        raise
     except httpx.TimeoutException:
-        yield f"data: {json.dumps({'error': 'Request timed out'})}\n\n"
+        span.finish(timer.finish("timeout"), error="Request timed out")
+        yield encode_event({"error": "Request timed out"})
     except httpx.RequestError as e:
-        yield f"data: {json.dumps({'error': f'Request failed: {str(e)}'})}\n\n"
+        span.finish(timer.finish("error"), error=str(e))
+        yield encode_event({"error": f"Request failed: {str(e)}"})
+    finally:
+        ticket.release()
 
 
 async def get_chat_response(
@@ -126,9 +382,13 @@ async def get_chat_response(
     messages: list,
     temperature: float,
     max_tokens: int,
+    client_id: str = "unknown",
+    prefix: Optional[str] = None,
 ) -> dict:
-    """Get non-streaming response from an LLM API."""
-    url = f"{model_url.rstrip('/')}/v1/chat/completions"
+    """
+    Get non-streaming response from an LLM API.
+    The serving metrics for the call are added to the result under "metrics".
+    """
     payload = {
         "model": model_name,
         "messages": messages,
@@ -138,56 +398,147 @@ async def get_chat_response(
     }
 
     try:
-        response = await http_client.post(url, json=payload)
+        ticket = await get_scheduler(model_url).enqueue(client_id)
+    except QueueFull as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    timer = GenerationTimer(model_name)
+    span = UpstreamSpan(model_name)
+    try:
+        await ticket.acquire()
+        with upstreams.get(model_url).acquire(prefix) as lease:
+            if prefix:
+                prefix_tracker.record(model_name, lease.url, prefix)
+            span.start(lease.url)
+            timer.start()
+            response = await http_client.post(
+                f"{lease.url}/v1/chat/completions", json=payload, headers=span.headers()
+            )
+            record_upstream_status(lease, response.status_code)
         if response.status_code != 200:
+            span.finish(timer.finish(response.status_code), error=f"HTTP {response.status_code}")
             raise HTTPException(status_code=response.status_code, detail=response.text)
-        return response.json()
+        result = response.json()
+        usage = result.get("usage") or {}
+        timer.completed(usage.get("completion_tokens", 0))
+        result["metrics"] = timer.finish(response.status_code)
+        span.finish(result["metrics"], usage)
+        return result
+    except asyncio.CancelledError:
+        if timer.started is not None and timer.status is None:
+            span.finish(timer.finish("cancelled"), cancelled=True)
+            record_cancellation(model_name, max_tokens, 0)
+        raise
     except httpx.TimeoutException:
+        span.finish(timer.finish("timeout"), error="Request timed out")
         raise HTTPException(status_code=504, detail="Request timed out")
     except httpx.RequestError as e:
+        span.finish(timer.finish("error"), error=str(e))
         raise HTTPException(status_code=502, detail=f"Request failed: {str(e)}")
+    finally:
+        ticket.release()
+
+
+async def count_tokens(model_url: str, text: str) -> tuple:
+    """
+    Count prompt tokens with the model's /tokenize endpoint.
+    Returns (count, max_model_len); max_model_len is None if unknown.
+    """
+    try:
+        with upstreams.get(model_url).acquire() as lease:
+            response = await http_client.post(f"{lease.url}/tokenize", json={"prompt": text})
+            record_upstream_status(lease, response.status_code)
+        if response.status_code == 200:
+            data = response.json()
+            return data.get("count", len(data.get("tokens", []))), data.get("max_model_len")
+    except httpx.RequestError:
+        pass
+    # Tokenizer unavailable: estimate roughly four characters per token
+    return len(text) // 4 + 1, None
+
+
+async def prepare_session(session_id: str, model_url: str, message: str, max_tokens: int) -> tuple:
+    """
+    Build the trimmed message list for the next turn of a session.
+    Returns (session, pending user message, upstream messages, info) where info
+    describes the context window for the UI. A session_id the server doesn't
+    know is not adopted: a new session is started under an id of our own.
+    """
+    session = await sessions.get(session_id) or await sessions.create()
+    tokens, max_model_len = await count_tokens(model_url, message)
+    budget = min(SESSION_TOKEN_BUDGET, max_model_len or SESSION_TOKEN_BUDGET)
+    pending = {"role": "user", "content": message, "tokens": tokens}
+    messages, prompt_tokens, dropped = session.window(pending, budget - max_tokens)
+    info = {
+        "id": session.id,
+        "prompt_tokens": prompt_tokens,
+        "budget": budget,
+        "messages": len(messages),
+        "dropped": dropped,
+    }
+    return session, pending, messages, info
+
+
+async def stream_with_session(session, pending: dict, info: dict, stream, reply: dict):
+    """Announce the context window, relay the reply, then store the exchange."""
+    yield encode_event({"session": info})
+    async with aclosing(stream):
+        async for chunk in stream:
+            yield chunk
+    if reply:
+        await sessions.add_turn(session.id, pending, {"role": "assistant", **reply})
 
 
 @app.get("/")
-async def root():
+async def root(request: Request):
     """Serve the main UI."""
-    return FileResponse(STATIC_DIR / "index.html")
+    return assets.response(request, "index.html")
 
 
 @app.get("/chat")
-async def chat_page():
+async def chat_page(request: Request):
     """Serve the chat UI."""
-    return FileResponse(STATIC_DIR / "chat.html")
+    return assets.response(request, "chat.html")
 
 
 @app.get("/playground")
-async def playground_page():
+async def playground_page(request: Request):
     """Serve the playground UI."""
-    return FileResponse(STATIC_DIR / "playground.html")
+    return assets.response(request, "playground.html")
 
 
 @app.get("/compare")
-async def compare_page():
+async def compare_page(request: Request):
     """Serve the compare UI."""
-    return FileResponse(STATIC_DIR / "compare.html")
+    return assets.response(request, "compare.html")
 
 
 @app.get("/context")
-async def context_page():
+async def context_page(request: Request):
     """Serve the context demo UI."""
-    return FileResponse(STATIC_DIR / "context.html")
+    return assets.response(request, "context.html")
 
 
 @app.get("/max-length")
-async def max_length_page():
+async def max_length_page(request: Request):
     """Serve the max length demo UI."""
-    return FileResponse(STATIC_DIR / "max-length.html")
+    return assets.response(request, "max-length.html")
 
 
 @app.get("/tokenizer")
-async def tokenizer_page():
+async def tokenizer_page(request: Request):
     """Serve the tokenizer playground UI."""
-    return FileResponse(STATIC_DIR / "tokenizer.html")
+    return assets.response(request, "tokenizer.html")
+
+
+@app.api_route("/static/{name:path}", methods=["GET", "HEAD"])
+async def static_asset(name: str, request: Request):
+    """Serve a static file; fingerprinted names are cached for a year."""
+    return assets.response(request, name)
 
 
 @app.post("/api/tokenize")
@@ -201,23 +552,25 @@ async def tokenize(request: Request):
     if not text:
         return {"tokens": [], "count": 0}
 
-    url = f"{DEFAULT_MODEL_URL.rstrip('/')}/tokenize"
     try:
-        response = await http_client.post(url, json={"prompt": text})
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-        data = response.json()
-        token_ids = data.get("tokens", [])
-
-        # Detokenize each token individually to get per-token text
-        token_texts = []
-        for tid in token_ids:
-            dt_url = f"{DEFAULT_MODEL_URL.rstrip('/')}/detokenize"
-            dt_resp = await http_client.post(dt_url, json={"tokens": [tid]})
-            if dt_resp.status_code == 200:
-                token_texts.append(dt_resp.json().get("prompt", ""))
-            else:
-                token_texts.append(f"[{tid}]")
+        # Keep the tokenize and detokenize calls on one replica
+        with upstreams.get(DEFAULT_MODEL_URL).acquire() as lease:
+            response = await http_client.post(f"{lease.url}/tokenize", json={"prompt": text})
+            record_upstream_status(lease, response.status_code)
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=response.text)
+            data = response.json()
+            token_ids = data.get("tokens", [])
+
+            # Detokenize each token individually to get per-token text
+            token_texts = []
+            for tid in token_ids:
+                dt_url = f"{lease.url}/detokenize"
+                dt_resp = await http_client.post(dt_url, json={"tokens": [tid]})
+                if dt_resp.status_code == 200:
+                    token_texts.append(dt_resp.json().get("prompt", ""))
+                else:
+                    token_texts.append(f"[{tid}]")
 
         return {"tokens": token_ids, "token_texts": token_texts, "count": len(token_ids)}
     except httpx.TimeoutException:
@@ -232,9 +585,72 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/api/upstreams")
+async def upstream_status():
+    """Return per-replica load, health and latency for each model."""
+    return upstreams.stats()
+
+
+@app.get("/api/stats")
+async def proxy_stats():
+    """Return counts of generations cancelled because the client disconnected."""
+    # tokens_saved is an upper bound: max_tokens minus the tokens already generated
+    others = await worker_metrics.others()
+    return {
+        "cancelled_generations": CANCELLED_GENERATIONS.total(others),
+        "tokens_saved": TOKENS_SAVED.total(others),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: TTFT, inter-token latency, tokens/sec and queue time per model, summed over workers."""
+    return Response(registry.render(await worker_metrics.others()), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/prefixes")
+async def prefix_stats():
+    """Return per-model system prompt reuse rates for the playground."""
+    return prefix_tracker.stats()
+
+
+@app.get("/api/sessions")
+async def session_store_status():
+    """Return the number of stored sessions and LRU evictions."""
+    return await sessions.stats()
+
+
+@app.post("/api/sessions")
+async def create_session():
+    """Start a conversation; pass the returned id as session_id to /api/chat."""
+    session = await sessions.create()
+    return {"id": session.id}
+
+
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str):
+    """Return a session's stored history; the id is the only credential, so it is never client-chosen."""
+    session = await sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {**session.stats(), "history": [{"role": m["role"], "content": m["content"]} for m in session.messages]}
+
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Forget a session's history."""
+    return {"deleted": await sessions.delete(session_id)}
+
+
+@app.get("/api/queue")
+async def queue_status():
+    """Return active and queued request counts per model."""
+    return schedulers.stats()
+
+
 @app.get("/config")
 async def get_config():
-    """Return current configuration."""
+    """Return current configuration and the cached model status."""
     return {
         "default_model_url": DEFAULT_MODEL_URL,
         "default_model_name": DEFAULT_MODEL_NAME,
@@ -242,241 +658,418 @@ async def get_config():
         "tiny_model_name": TINY_MODEL_NAME,
         "compressed_model_url": COMPRESSED_MODEL_URL,
         "compressed_model_name": COMPRESSED_MODEL_NAME,
+        "models": discovery.snapshot(),
+        "workers": {"configured": WORKERS, "publishing": await worker_metrics.workers(), "shared_state": state.name},
     }
 
 
 @app.post("/api/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, raw_request: Request):
     """
     Basic chat endpoint.
     Sends a message to the default model and returns the response.
-    Supports streaming (SSE) when stream=true.
+    Supports streaming (SSE) when stream=true. With a session_id the stored
+    history is sent along, trimmed to the token budget, and a {"session": ...}
+    event reports how many earlier messages were dropped.
     """
     messages = [{"role": "user", "content": request.message}]
+    client_id = get_client_id(raw_request)
+    await check_admission(DEFAULT_MODEL_URL, client_id)
+
+    session = None
+    if request.session_id:
+        session, pending, messages, info = await prepare_session(
+            request.session_id, DEFAULT_MODEL_URL, request.message, request.max_tokens
+        )
 
     if request.stream:
+        reply = {}
+        body = stream_chat_response(
+            DEFAULT_MODEL_URL,
+            DEFAULT_MODEL_NAME,
+            messages,
+            request.temperature,
+            request.max_tokens,
+            client_id,
+            # Session replies are re-framed so they can be recorded
+            request.passthrough and session is None,
+            reply,
+        )
+        if session is not None:
+            body = stream_with_session(session, pending, info, body, reply)
         return StreamingResponse(
-            stream_chat_response(
-                DEFAULT_MODEL_URL,
-                DEFAULT_MODEL_NAME,
-                messages,
-                request.temperature,
-                request.max_tokens,
-            ),
+            cancel_on_disconnect(raw_request.receive, body),
             media_type="text/event-stream",
         )
     else:
-        result = await get_chat_response(
+        result = await call_until_disconnect(raw_request.receive, get_chat_response(
             DEFAULT_MODEL_URL,
             DEFAULT_MODEL_NAME,
             messages,
             request.temperature,
             request.max_tokens,
-        )
+            client_id,
+        ))
         content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-        return {"content": content}
+        if session is not None:
+            tokens = (result.get("usage") or {}).get("completion_tokens", 0)
+            await sessions.add_turn(session.id, pending, {"role": "assistant", "content": content, "tokens": tokens})
+            return {"content": content, "metrics": result["metrics"], "session": info}
+        return {"content": content, "metrics": result["metrics"]}
 
 
 @app.post("/api/chat/playground")
-async def chat_playground(request: PlaygroundRequest):
+async def chat_playground(request: PlaygroundRequest, raw_request: Request):
     """
     Playground endpoint with customizable system prompt and model.
-    Allows specifying custom model URL and name.
+    Allows specifying custom model URL and name. The system prompt is
+    normalized and always sent first, so requests sharing it share a token
+    prefix, and its fingerprint routes them to the same replica.
     """
     model_url = request.model_url or DEFAULT_MODEL_URL
     model_name = request.model_name or DEFAULT_MODEL_NAME
+    client_id = get_client_id(raw_request)
+    await check_admission(model_url, client_id)
 
-    messages = [
-        {"role": "system", "content": request.system_prompt},
-        {"role": "user", "content": request.user_prompt},
-    ]
+    system_prompt = normalize_prompt(request.system_prompt or "")
+    messages = [{"role": "user", "content": request.user_prompt}]
+    prefix = None
+    if system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+        prefix = prefix_fingerprint(model_name, system_prompt)
 
     if request.stream:
         return StreamingResponse(
-            stream_chat_response(
+            cancel_on_disconnect(raw_request.receive, stream_chat_response(
                 model_url,
                 model_name,
                 messages,
                 request.temperature,
                 request.max_tokens,
-            ),
+                client_id,
+                request.passthrough,
+                prefix=prefix,
+            )),
             media_type="text/event-stream",
         )
     else:
-        result = await get_chat_response(
+        result = await call_until_disconnect(raw_request.receive, get_chat_response(
             model_url,
             model_name,
             messages,
             request.temperature,
             request.max_tokens,
-        )
+            client_id,
+            prefix,
+        ))
         content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-        return {"content": content}
+        return {"content": content, "metrics": result["metrics"]}
 
 
 @app.post("/api/chat/context")
-async def chat_context(request: ChatRequest):
+async def chat_context(request: ChatRequest, raw_request: Request):
     """
     Context demo endpoint - same as chat but uses default model.
     Useful for testing token limits.
     """
-    return await chat(request)
+    return await chat(request, raw_request)
 
 
 @app.post("/api/chat/max-length")
-async def chat_max_length(request: ChatRequest):
+async def chat_max_length(request: ChatRequest, raw_request: Request):
     """
     Max length demo endpoint - uses the tiny model for testing output length.
     """
     messages = [{"role": "user", "content": request.message}]
+    client_id = get_client_id(raw_request)
+    await check_admission(TINY_MODEL_URL, client_id)
 
     if request.stream:
         return StreamingResponse(
-            stream_chat_response(
+            cancel_on_disconnect(raw_request.receive, stream_chat_response(
                 TINY_MODEL_URL,
                 TINY_MODEL_NAME,
                 messages,
                 request.temperature,
                 request.max_tokens,
-            ),
+                client_id,
+                request.passthrough,
+            )),
             media_type="text/event-stream",
         )
     else:
-        result = await get_chat_response(
+        result = await call_until_disconnect(raw_request.receive, get_chat_response(
             TINY_MODEL_URL,
             TINY_MODEL_NAME,
             messages,
             request.temperature,
             request.max_tokens,
-        )
+            client_id,
+        ))
         content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-        return {"content": content}
+        return {"content": content, "metrics": result["metrics"]}
+
+
+async def stream_compare_model(
+    model_id: int,
+    model_url: str,
+    model_name: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    client_id: str,
+):
+    """Stream one model's side of a comparison as delta events with running metrics."""
+    base = {"model_id": model_id, "model_name": model_name}
+    payload = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+    if STREAM_INCLUDE_USAGE:
+        payload["stream_options"] = {"include_usage": True}
+    timer = GenerationTimer(model_name)
+    span = UpstreamSpan(model_name)
+    usage = {}
+
+    def elapsed() -> float:
+        return time.perf_counter() - (timer.started or timer.created)
+
+    def error_event(message: str, status: str) -> dict:
+        metrics = timer.finish(status)
+        span.finish(metrics, usage, error=message)
+        return {
+            **base,
+            "content": message,
+            "time": elapsed(),
+            "metrics": metrics,
+            "done": True,
+            "error": True,
+        }
+
+    try:
+        ticket = await get_scheduler(model_url).enqueue(client_id)
+    except QueueFull as e:
+        yield {**base, "content": str(e), "time": 0.0, "done": True, "error": True}
+        return
+
+    try:
+        async for position in ticket.wait():
+            yield {**base, "queue_position": position}
+
+        with upstreams.get(model_url).acquire() as lease:
+            url = f"{lease.url}/v1/chat/completions"
+            span.start(lease.url)
+            timer.start()
+            async with http_client.stream("POST", url, json=payload, headers=span.headers()) as response:
+                record_upstream_status(lease, response.status_code)
+                if response.status_code != 200:
+                    error_text = await response.aread()
+                    yield error_event(f"Error {response.status_code}: {error_text.decode()}", response.status_code)
+                    return
+
+                async for delta, count in relay_content(
+                    response.aiter_bytes(), SSE_BATCH_MAX_CHARS, SSE_BATCH_WINDOW_MS / 1000, usage
+                ):
+                    timer.tokens_received(count)
+                    running = timer.summary()
+                    yield {
+                        **base,
+                        "delta": delta,
+                        "time": elapsed(),
+                        "ttft": running["ttft"],
+                        "tokens": timer.tokens,
+                        "tokens_per_second": running["tokens_per_second"],
+                        "done": False,
+                        "error": False,
+                    }
+
+                metrics = timer.finish(response.status_code)
+                span.finish(metrics, usage)
+        yield {
+            **base,
+            "delta": "",
+            "time": elapsed(),
+            "ttft": metrics["ttft"],
+            "tokens": timer.tokens,
+            "tokens_per_second": metrics["tokens_per_second"],
+            "metrics": metrics,
+            "done": True,
+            "error": False,
+        }
+
+    except asyncio.CancelledError:
+        if timer.started is not None and timer.status is None:
+            span.finish(timer.finish("cancelled"), usage, cancelled=True)
+            record_cancellation(model_name, max_tokens, timer.tokens)
+        raise
+    except httpx.TimeoutException:
+        yield error_event("Request timed out", "timeout")
+    except httpx.RequestError as e:
+        yield error_event(f"Request failed: {str(e)}", "error")
+    finally:
+        ticket.release()
 
 
 @app.post("/api/chat/compare")
-async def compare_models(request: CompareRequest):
+async def compare_models(request: CompareRequest, raw_request: Request):
     """
-    Compare two models side by side.
-    Streams responses from both models concurrently with timing information.
+    Compare models side by side.
+    Streams responses from all models concurrently. Each event carries the new
+    text for one model ("delta") plus its running time, TTFT and token rate.
     """
-    model_url_1 = request.model_url_1 or DEFAULT_MODEL_URL
-    model_name_1 = request.model_name_1 or DEFAULT_MODEL_NAME
-    model_url_2 = request.model_url_2 or COMPRESSED_MODEL_URL
-    model_name_2 = request.model_name_2 or COMPRESSED_MODEL_NAME
+    if request.models:
+        targets = [
+            (target.url or DEFAULT_MODEL_URL, target.name or DEFAULT_MODEL_NAME)
+            for target in request.models
+        ]
+    else:
+        targets = [
+            (request.model_url_1 or DEFAULT_MODEL_URL, request.model_name_1 or DEFAULT_MODEL_NAME),
+            (request.model_url_2 or COMPRESSED_MODEL_URL, request.model_name_2 or COMPRESSED_MODEL_NAME),
+        ]
+    client_id = get_client_id(raw_request)
+    for model_url, _ in targets:
+        await check_admission(model_url, client_id)
 
     messages = [{"role": "user", "content": request.prompt}]
 
     async def compare_stream():
-        start_time = time.time()
-        queue = asyncio.Queue()
-
-        async def stream_model(model_url, model_name, model_id):
-            """Stream from a single model and put chunks in the queue."""
-            url = f"{model_url.rstrip('/')}/v1/chat/completions"
-            payload = {
-                "model": model_name,
-                "messages": messages,
-                "temperature": request.temperature,
-                "max_tokens": request.max_tokens,
-                "stream": True,
+        sources = [
+            stream_compare_model(
+                model_id,
+                model_url,
+                model_name,
+                messages,
+                request.temperature,
+                request.max_tokens,
+                client_id,
+            )
+            for model_id, (model_url, model_name) in enumerate(targets, start=1)
+        ]
+        async with aclosing(merge_streams(sources)) as updates:
+            async for update in updates:
+                yield encode_event(update)
+        yield DONE_EVENT
+
+    return StreamingResponse(
+        cancel_on_disconnect(raw_request.receive, compare_stream()),
+        media_type="text/event-stream",
+    )
+
+
+async def run_batch_cell(cell: dict, messages: list, prefix: Optional[str], max_tokens: int, client_id: str, slots):
+    """Run one batch cell once a slot is free and yield its result event."""
+    async with slots:
+        started = time.perf_counter()
+        try:
+            result = await get_chat_response(
+                cell["model_url"],
+                cell["model_name"],
+                messages,
+                cell["temperature"],
+                max_tokens,
+                client_id,
+                prefix,
+            )
+            usage = result.get("usage") or {}
+            event = {
+                "cell": cell,
+                "content": result.get("choices", [{}])[0].get("message", {}).get("content", ""),
+                "latency": time.perf_counter() - started,
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "metrics": result["metrics"],
+            }
+        except HTTPException as e:
+            event = {
+                "cell": cell,
+                "error": str(e.detail),
+                "status": e.status_code,
+                "latency": time.perf_counter() - started,
             }
+        except Exception as e:
+            # E.g. a 200 with a body that isn't JSON: one bad cell must not end the batch unreported
+            logger.exception("Batch cell %s failed", cell["index"])
+            event = {
+                "cell": cell,
+                "error": f"Request failed: {e}",
+                "status": 502,
+                "latency": time.perf_counter() - started,
+            }
+    yield event
+
 
-            content = ""
-            model_start = time.time()
-
-            try:
-                async with http_client.stream("POST", url, json=payload) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        elapsed = time.time() - model_start
-                        await queue.put({
-                            "model_id": model_id,
-                            "model_name": model_name,
-                            "content": f"Error {response.status_code}: {error_text.decode()}",
-                            "time": elapsed,
-                            "done": True,
-                            "error": True,
-                        })
-                        return
-
-                    async for line in response.aiter_lines():
-                        if not line or not line.startswith("data: "):
-                            continue
-                        data = line[6:]
-                        if data == "[DONE]":
-                            break
-                        try:
-                            chunk = json.loads(data)
-                            delta = chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                            if delta:
-                                content += delta
-                                elapsed = time.time() - model_start
-                                await queue.put({
-                                    "model_id": model_id,
-                                    "model_name": model_name,
-                                    "content": content,
-                                    "time": elapsed,
-                                    "done": False,
-                                    "error": False,
-                                })
-                        except json.JSONDecodeError:
-                            continue
-
-                elapsed = time.time() - model_start
-                await queue.put({
-                    "model_id": model_id,
-                    "model_name": model_name,
-                    "content": content,
-                    "time": elapsed,
-                    "done": True,
-                    "error": False,
-                })
-
-            except httpx.TimeoutException:
-                elapsed = time.time() - model_start
-                await queue.put({
-                    "model_id": model_id,
-                    "model_name": model_name,
-                    "content": "Request timed out",
-                    "time": elapsed,
-                    "done": True,
-                    "error": True,
-                })
-            except Exception as e:
-                elapsed = time.time() - model_start
-                await queue.put({
-                    "model_id": model_id,
-                    "model_name": model_name,
-                    "content": str(e),
-                    "time": elapsed,
-                    "done": True,
-                    "error": True,
-                })
-
-        # Start both streaming tasks
-        task1 = asyncio.create_task(stream_model(model_url_1, model_name_1, 1))
-        task2 = asyncio.create_task(stream_model(model_url_2, model_name_2, 2))
-
-        done_count = 0
-        while done_count < 2:
-            try:
-                update = await asyncio.wait_for(queue.get(), timeout=0.1)
-                yield f"data: {json.dumps(update)}\n\n"
-                if update.get("done"):
-                    done_count += 1
-            except asyncio.TimeoutError:
-                # Check if tasks are still running
-                if task1.done() and task2.done():
-                    break
-                continue
-
-        await task1
-        await task2
-        yield "data: [DONE]\n\n"
-
-    return StreamingResponse(compare_stream(), media_type="text/event-stream")
+@app.post("/api/chat/batch")
+async def chat_batch(request: BatchRequest, raw_request: Request):
+    """
+    Evaluate a prompt matrix in one job.
+    Runs every system prompt x user prompt x temperature x model combination
+    through the scheduler with bounded concurrency and streams one
+    {"cell": ..., "content", "latency", ...} event per cell as it completes,
+    then a {"summary": ...} event.
+    """
+    targets = [
+        (target.url or DEFAULT_MODEL_URL, target.name or DEFAULT_MODEL_NAME)
+        for target in request.models or [CompareModel()]
+    ]
+    combinations = list(itertools.product(
+        targets, enumerate(request.system_prompts), enumerate(request.user_prompts), request.temperatures
+    ))
+    if len(combinations) > MAX_BATCH_CELLS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Batch has {len(combinations)} combinations; the limit is {MAX_BATCH_CELLS}.",
+        )
+    client_id = get_client_id(raw_request)
+    for model_url in {model_url for model_url, _ in targets}:
+        await check_admission(model_url, client_id)
+
+    # More cells in flight than the per-client queue allows would only earn 429s
+    slots = asyncio.Semaphore(min(request.concurrency, MAX_QUEUED_PER_CLIENT))
+    sources = []
+    for index, ((model_url, model_name), (s, system_prompt), (u, user_prompt), temperature) in enumerate(combinations):
+        system_prompt = normalize_prompt(system_prompt)
+        messages = [{"role": "user", "content": user_prompt}]
+        prefix = None
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
+            prefix = prefix_fingerprint(model_name, system_prompt)
+        cell = {
+            "index": index,
+            "system_prompt_index": s,
+            "user_prompt_index": u,
+            "temperature": temperature,
+            "model_name": model_name,
+            "model_url": model_url,
+        }
+        sources.append(run_batch_cell(cell, messages, prefix, request.max_tokens, client_id, slots))
+
+    async def batch_stream():
+        started = time.perf_counter()
+        succeeded = 0
+        async with aclosing(merge_streams(sources)) as results:
+            async for result in results:
+                if "error" not in result:
+                    succeeded += 1
+                yield encode_event(result)
+        # A cell without a result event is a failure too
+        yield encode_event({"summary": {
+            "cells": len(sources),
+            "succeeded": succeeded,
+            "failed": len(sources) - succeeded,
+            "elapsed": time.perf_counter() - started,
+        }})
+        yield DONE_EVENT
+
+    return StreamingResponse(
+        cancel_on_disconnect(raw_request.receive, batch_stream()),
+        media_type="text/event-stream",
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKERS)
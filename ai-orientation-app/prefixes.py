@@ -0,0 +1,85 @@
+"""
+Shared system prompt handling for the playground.
+
+A class tends to reuse a handful of system prompts. vLLM's prefix cache can
+skip prompt processing for a repeated prefix, but only if the tokens match
+exactly and the request lands on the replica that has them cached. So system
+prompts are normalized (line endings, surrounding and trailing whitespace) and
+fingerprinted; the fingerprint is used as the replica affinity key, and each
+model's prefix reuse rate is tracked from the fingerprints each replica has
+served recently. Models and replicas are client-supplied in the playground, so
+the tracker keeps bounded, least-recently-used state for them.
+"""
+
+import re
+import hashlib
+from collections import OrderedDict
+
+from telemetry import PREFIX_REQUESTS, PREFIX_REUSED, model_label
+
+_TRAILING_SPACE = re.compile(r"[ \t]+$", re.MULTILINE)
+
+
+def normalize_prompt(text: str) -> str:
+    """Canonical form of a system prompt; whitespace-only variants become identical."""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return _TRAILING_SPACE.sub("", text).strip()
+
+
+def prefix_fingerprint(model_name: str, system_prompt: str) -> str:
+    """Short stable id of a (model, normalized system prompt) prefix."""
+    return hashlib.blake2b(f"{model_name}\0{system_prompt}".encode(), digest_size=8).hexdigest()
+
+
+class PrefixTracker:
+    """Remembers the prefixes each replica served recently to estimate cache reuse."""
+
+    def __init__(self, capacity: int = 64, max_endpoints: int = 64, max_prefixes: int = 1024):
+        # Roughly how many distinct prefixes a replica's cache is assumed to hold
+        self.capacity = capacity
+        # Replicas tracked, and prefix counts kept per model, least recently used dropped first
+        self.max_endpoints = max_endpoints
+        self.max_prefixes = max_prefixes
+        self._recent: "OrderedDict[str, OrderedDict]" = OrderedDict()
+        # Keyed by metric label, so client-named models share the "custom" entry
+        self._models: dict = {}
+
+    def record(self, model: str, endpoint_url: str, fingerprint: str) -> bool:
+        """Count a request; returns True if its prefix was recently served by the same replica."""
+        recent = self._recent.get(endpoint_url)
+        if recent is None:
+            recent = self._recent[endpoint_url] = OrderedDict()
+            if len(self._recent) > self.max_endpoints:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(endpoint_url)
+        reused = fingerprint in recent
+        recent[fingerprint] = True
+        recent.move_to_end(fingerprint)
+        if len(recent) > self.capacity:
+            recent.popitem(last=False)
+
+        model = model_label(model)
+        prefixes = self._models.setdefault(model, OrderedDict())
+        prefixes[fingerprint] = prefixes.pop(fingerprint, 0) + 1
+        if len(prefixes) > self.max_prefixes:
+            prefixes.popitem(last=False)
+        PREFIX_REQUESTS.inc(model=model)
+        if reused:
+            PREFIX_REUSED.inc(model=model)
+        return reused
+
+    def stats(self) -> dict:
+        result = {}
+        for model, prefixes in self._models.items():
+            requests = PREFIX_REQUESTS.value(model=model)
+            reused = PREFIX_REUSED.value(model=model)
+            top = sorted(prefixes.items(), key=lambda item: item[1], reverse=True)[:5]
+            result[model] = {
+                "requests": requests,
+                "reused": reused,
+                "reuse_rate": reused / requests if requests else 0.0,
+                "distinct_prefixes": len(prefixes),
+                "top_prefixes": [{"fingerprint": fp, "requests": count} for fp, count in top],
+            }
+        return result
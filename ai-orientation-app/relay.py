@@ -0,0 +1,216 @@
+"""
+Low-overhead relay of upstream OpenAI-style SSE streams.
+
+The upstream sends one `data: {...}` line per token. Instead of decoding every
+line to str, parsing the whole chunk with json and re-encoding a new frame per
+token, this module works on raw bytes, uses orjson when it is installed, and
+coalesces the deltas that arrive together into a single outgoing frame.
+
+Run `python relay.py` for a microbenchmark of tokens relayed per second.
+"""
+
+import asyncio
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
+
+DONE_EVENT = b"data: [DONE]\n\n"
+_DONE_MARKER = b"[DONE]"
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+
+def encode_event(obj) -> bytes:
+    """Encode an object as a single SSE data frame."""
+    return b"data: " + dumps(obj) + b"\n\n"
+
+
+def parse_chunk(payload: bytes):
+    """
+    Return (delta, usage) from a chat.completion.chunk payload.
+
+    delta is '' when the chunk carries no content; usage is the token usage
+    dict sent in the final chunk when stream_options.include_usage is set.
+    """
+    try:
+        chunk = loads(payload)
+    except ValueError:
+        return "", None
+    if not isinstance(chunk, dict):
+        return "", None
+    try:
+        delta = chunk["choices"][0]["delta"].get("content") or ""
+    except (KeyError, IndexError, TypeError, AttributeError):
+        delta = ""
+    return delta, chunk.get("usage")
+
+
+async def iter_sse_payloads(byte_iter):
+    """Yield the `data:` payloads found in each network read, as lists of bytes."""
+    buffer = b""
+    async for chunk in byte_iter:
+        buffer += chunk
+        if b"\n" not in chunk:
+            continue
+        *lines, buffer = buffer.split(b"\n")
+        payloads = []
+        for line in lines:
+            if line.startswith(b"data:"):
+                payloads.append(line[5:].strip())
+        if payloads:
+            yield payloads
+
+
+async def relay_content(byte_iter, max_chars: int = 256, window: float = 0.0, usage: dict = None):
+    """
+    Yield (text, deltas) batches of content from an upstream SSE byte stream.
+
+    With window=0 every delta that arrived in the same network read goes out
+    together, which never delays data that is already here. A positive window
+    (seconds) also holds deltas back until the window expires or max_chars is
+    buffered, trading a little latency for fewer frames.
+
+    If a `usage` dict is given it is updated with the token counts reported
+    by the upstream's final usage chunk.
+    """
+    if window <= 0:
+        async for payloads in iter_sse_payloads(byte_iter):
+            parts = []
+            finished = False
+            for payload in payloads:
+                if payload == _DONE_MARKER:
+                    finished = True
+                    break
+                delta, chunk_usage = parse_chunk(payload)
+                if chunk_usage and usage is not None:
+                    usage.update(chunk_usage)
+                if delta:
+                    parts.append(delta)
+            if parts:
+                yield "".join(parts), len(parts)
+            if finished:
+                return
+        return
+
+    loop = asyncio.get_running_loop()
+    reader = iter_sse_payloads(byte_iter).__aiter__()
+    buffered = []
+    size = 0
+    deadline = 0.0
+    next_read = None
+    try:
+        while True:
+            if next_read is None:
+                next_read = asyncio.ensure_future(reader.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffered else None
+            done, _ = await asyncio.wait({next_read}, timeout=timeout)
+            if not done:
+                # Window expired while the upstream is quiet: flush what we have
+                yield "".join(buffered), len(buffered)
+                buffered, size = [], 0
+                continue
+
+            finished_read, next_read = next_read, None
+            try:
+                payloads = finished_read.result()
+            except StopAsyncIteration:
+                break
+
+            finished = False
+            for payload in payloads:
+                if payload == _DONE_MARKER:
+                    finished = True
+                    break
+                delta, chunk_usage = parse_chunk(payload)
+                if chunk_usage and usage is not None:
+                    usage.update(chunk_usage)
+                if delta:
+                    if not buffered:
+                        deadline = loop.time() + window
+                    buffered.append(delta)
+                    size += len(delta)
+            if finished:
+                break
+            if size >= max_chars:
+                yield "".join(buffered), len(buffered)
+                buffered, size = [], 0
+        if buffered:
+            yield "".join(buffered), len(buffered)
+    finally:
+        if next_read is not None:
+            next_read.cancel()
+
+
+def _benchmark(tokens: int = 200_000, tokens_per_read: int = 1):
+    """Compare the legacy per-line relay with the batched and pass-through paths."""
+    import time
+
+    line = json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "model": "bench",
+        "choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": None}],
+    }).encode()
+    frame = b"data: " + line + b"\n\n"
+    chunks = [frame * tokens_per_read] * (tokens // tokens_per_read) + [DONE_EVENT]
+
+    async def upstream():
+        for chunk in chunks:
+            yield chunk
+
+    async def legacy():
+        # Mirrors the original aiter_lines / json.loads / json.dumps loop
+        frames = 0
+        async for chunk in upstream():
+            for text_line in chunk.decode().splitlines():
+                if not text_line or not text_line.startswith("data: "):
+                    continue
+                data = text_line[6:]
+                if data == "[DONE]":
+                    break
+                content = json.loads(data).get("choices", [{}])[0].get("delta", {}).get("content", "")
+                if content:
+                    f"data: {json.dumps({'content': content})}\n\n".encode()
+                    frames += 1
+        return frames
+
+    async def batched():
+        frames = 0
+        async for text, _ in relay_content(upstream()):
+            encode_event({"content": text})
+            frames += 1
+        return frames
+
+    async def passthrough():
+        frames = 0
+        async for _ in upstream():
+            frames += 1
+        return frames
+
+    print(f"json backend: {'orjson' if orjson is not None else 'json'}, "
+          f"{tokens} tokens, {tokens_per_read} token(s) per upstream read")
+    for name, relay in (("legacy", legacy), ("batched", batched), ("passthrough", passthrough)):
+        start = time.process_time()
+        frames = asyncio.run(relay())
+        elapsed = time.process_time() - start
+        print(f"{name:>12}: {tokens / elapsed:>12,.0f} tokens/s per core, {frames} frames")
+
+
+if __name__ == "__main__":
+    import sys
+
+    _benchmark(tokens_per_read=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
+    if len(sys.argv) == 1:
+        _benchmark(tokens_per_read=8)
@@ -0,0 +1,324 @@
+"""
+Admission control for upstream model calls.
+
+Each logical model gets a ModelScheduler that caps the number of concurrent
+upstream requests and holds everything else in a bounded wait queue. Waiters
+are grouped per client and served round-robin, so one student pressing "send"
+repeatedly cannot push the rest of the class to the back of the line.
+
+With several worker processes the concurrency cap and queue bound are split
+between the workers, so the model still sees at most the configured number of
+requests, and the per-client limit is counted in the shared store so a client
+cannot multiply it by spreading requests over workers. That shared count is
+bookkeeping only: it is read and written off the event loop, and a store error
+never blocks a request or strands a waiter. Every worker admits at
+least one request, so a cap below the number of workers can't be kept; that
+is logged as a warning when the model's scheduler is created.
+"""
+
+import math
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict, deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a request cannot be queued for a model."""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A single request's place in a model's queue."""
+
+    def __init__(self, scheduler: "ModelScheduler", client_id: str):
+        self.scheduler = scheduler
+        self.client_id = client_id
+        self.granted = False
+        self.released = False
+        self.granted_at = 0.0
+        self.enqueued_at = asyncio.get_running_loop().time()
+        # Counted in the shared per-client waiting counter
+        self.counted = False
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        """Wait for a slot, yielding the queue position whenever it changes."""
+        last_position = None
+        while not self.granted:
+            position = self.scheduler.position(self)
+            if position != last_position:
+                last_position = position
+                yield position
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def acquire(self):
+        """Wait for a slot without reporting queue positions."""
+        async for _ in self.wait():
+            pass
+
+    @property
+    def queue_time(self) -> float:
+        """Seconds spent waiting before the slot was granted."""
+        if not self.granted:
+            return 0.0
+        return self.granted_at - self.enqueued_at
+
+    def release(self):
+        """Give the slot back, or leave the queue if it was never granted."""
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+
+class ModelScheduler:
+    """Concurrency cap plus a fair, bounded wait queue for one model."""
+
+    # A waiting counter left behind by a crashed worker heals after this long
+    SHARED_COUNTER_TTL = 300
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_per_client: int, shared=None, key: str = ""):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.max_queue_per_client = max(1, max_queue_per_client)
+        # Store counting each client's waiting requests across workers, if any
+        self.shared = shared
+        self.key = key
+        self.active = 0
+        self.queued = 0
+        # client_id -> deque of waiting tickets, in round-robin order
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        # Smoothed time a request holds a slot, used for Retry-After hints
+        self._avg_service_time = 5.0
+        # Shared counter updates still running, kept referenced until done
+        self._bookkeeping: set = set()
+
+    async def check(self, client_id: str):
+        """Raise QueueFull if a new request from this client would be rejected."""
+        if self.active < self.max_concurrency and self.queued == 0:
+            return
+        waiting = self._waiters.get(client_id)
+        if waiting is not None and len(waiting) >= self.max_queue_per_client:
+            raise self._client_limit()
+        if self.shared is not None and await self._shared_waiting(client_id) >= self.max_queue_per_client:
+            raise self._client_limit()
+        if self.queued >= self.max_queue:
+            raise QueueFull(
+                "The model is busy. Please try again shortly.",
+                status_code=503,
+                retry_after=self.retry_after(),
+            )
+
+    async def enqueue(self, client_id: str) -> Ticket:
+        """Reserve a slot or a queue place for a client's request."""
+        await self.check(client_id)
+        ticket = Ticket(self, client_id)
+        if self.active < self.max_concurrency and self.queued == 0:
+            self._grant(ticket)
+            return ticket
+        if self.shared is not None:
+            try:
+                counted = await self.shared.run(
+                    self.shared.incr, self._client_key(client_id), 1, self.max_queue_per_client, self.SHARED_COUNTER_TTL)
+            except sqlite3.Error:
+                logger.warning("Counting a waiting request in the shared store failed", exc_info=True)
+                counted = None
+            if counted is False:
+                raise self._client_limit()
+            ticket.counted = bool(counted)
+        # A slot may have freed up while the store was busy
+        if self.active < self.max_concurrency and self.queued == 0:
+            self._grant(ticket)
+        else:
+            self._waiters.setdefault(client_id, deque()).append(ticket)
+            self.queued += 1
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """Number of requests that will be served before this ticket, plus one."""
+        own_queue = self._waiters.get(ticket.client_id)
+        if ticket.granted or own_queue is None:
+            return 0
+        index = own_queue.index(ticket)
+        ahead = 0
+        before_own = True
+        for client_id, waiting in self._waiters.items():
+            if client_id == ticket.client_id:
+                before_own = False
+                ahead += index
+            elif before_own:
+                ahead += min(len(waiting), index + 1)
+            else:
+                ahead += min(len(waiting), index)
+        return ahead + 1
+
+    def retry_after(self) -> int:
+        """Estimated seconds until a queue place frees up."""
+        backlog = self.queued + 1
+        return max(1, math.ceil(self._avg_service_time * backlog / self.max_concurrency))
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "clients_waiting": len(self._waiters),
+        }
+
+    def _client_limit(self) -> QueueFull:
+        return QueueFull(
+            "Too many requests waiting for this model. Please wait for your previous request to finish.",
+            status_code=429,
+            retry_after=self.retry_after(),
+        )
+
+    def _client_key(self, client_id: str) -> str:
+        return f"waiting:{self.key}:{client_id}"
+
+    async def _shared_waiting(self, client_id: str) -> int:
+        try:
+            return await self.shared.run(self.shared.counter, self._client_key(client_id))
+        except sqlite3.Error:
+            logger.warning("Reading the shared waiting count failed", exc_info=True)
+            return 0
+
+    async def _shared_decrement(self, key: str):
+        try:
+            await self.shared.run(self.shared.incr, key, -1, None, self.SHARED_COUNTER_TTL)
+        except sqlite3.Error:
+            # The counter heals on its own after SHARED_COUNTER_TTL
+            logger.warning("Uncounting a waiting request in the shared store failed", exc_info=True)
+
+    def _uncount(self, ticket: Ticket):
+        if ticket.counted:
+            ticket.counted = False
+            # In the background: a slot or a cancellation never waits for the store
+            task = asyncio.get_running_loop().create_task(self._shared_decrement(self._client_key(ticket.client_id)))
+            self._bookkeeping.add(task)
+            task.add_done_callback(self._bookkeeping.discard)
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted = True
+        ticket.granted_at = asyncio.get_running_loop().time()
+        self.active += 1
+        ticket._changed.set()
+        self._uncount(ticket)
+
+    def _release(self, ticket: Ticket):
+        if not ticket.granted:
+            waiting = self._waiters.get(ticket.client_id)
+            if waiting is not None and ticket in waiting:
+                waiting.remove(ticket)
+                self.queued -= 1
+                self._uncount(ticket)
+                if not waiting:
+                    del self._waiters[ticket.client_id]
+                self._notify_waiters()
+            return
+
+        held = asyncio.get_running_loop().time() - ticket.granted_at
+        self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * held
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting clients in round-robin order."""
+        while self.active < self.max_concurrency and self._waiters:
+            client_id, waiting = next(iter(self._waiters.items()))
+            ticket = waiting.popleft()
+            self.queued -= 1
+            # Rotate the client to the back so others get the next slot
+            del self._waiters[client_id]
+            if waiting:
+                self._waiters[client_id] = waiting
+            self._grant(ticket)
+        self._notify_waiters()
+
+    def _notify_waiters(self):
+        for waiting in self._waiters.values():
+            for ticket in waiting:
+                ticket._changed.set()
+
+
+class SchedulerRegistry:
+    """
+    Lazily creates one ModelScheduler per logical model.
+
+    Configured models keep their scheduler. Client-supplied model URLs are
+    capped at max_custom schedulers: idle ones are dropped least recently
+    used first, busy ones are kept until their requests finish.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        max_queue_per_client: int,
+        workers: int = 1,
+        shared=None,
+        max_custom: int = 16,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        # Number of worker processes sharing the limits, and their shared store
+        self.workers = max(1, workers)
+        self.shared = shared
+        self.max_custom = max_custom
+        self._limits: dict = {}
+        self._configured: set = set()
+        self._schedulers: "OrderedDict[str, ModelScheduler]" = OrderedDict()
+
+    def configure(self, model_key: str, max_concurrency: Optional[int] = None):
+        """Register a configured model, optionally overriding its concurrency cap."""
+        self._configured.add(model_key)
+        if max_concurrency is not None:
+            self._limits[model_key] = max_concurrency
+
+    def get(self, model_key: str, replicas: int = 1) -> ModelScheduler:
+        """Scheduler for a model; the cap applies per replica serving it, split over the workers."""
+        scheduler = self._schedulers.get(model_key)
+        if scheduler is None:
+            cap = self._limits.get(model_key, self.max_concurrency) * max(1, replicas)
+            if cap < self.workers:
+                logger.warning(
+                    "%s allows %d concurrent requests but there are %d workers, each admitting at least one: "
+                    "up to %d can reach it at once. Lower WEB_CONCURRENCY or raise its limit.",
+                    model_key, cap, self.workers, self.workers)
+            scheduler = ModelScheduler(
+                cap // self.workers,
+                self.max_queue // self.workers,
+                self.max_queue_per_client,
+                self.shared,
+                model_key,
+            )
+            self._schedulers[model_key] = scheduler
+            if model_key not in self._configured:
+                self._evict_custom()
+        elif model_key not in self._configured:
+            self._schedulers.move_to_end(model_key)
+        return scheduler
+
+    def _evict_custom(self):
+        custom = [key for key in self._schedulers if key not in self._configured]
+        excess = len(custom) - self.max_custom
+        for key in custom:
+            if excess <= 0:
+                break
+            scheduler = self._schedulers[key]
+            if scheduler.active == 0 and scheduler.queued == 0:
+                del self._schedulers[key]
+                excess -= 1
+
+    def stats(self) -> dict:
+        return {key: scheduler.stats() for key, scheduler in self._schedulers.items()}
@@ -0,0 +1,162 @@
+"""
+Server-side multi-turn conversation sessions.
+
+The browser sends only the new message plus a session id; the history lives
+here. Memory is bounded by an LRU cap on sessions and a cap on messages per
+session. Before each call the history is trimmed, oldest messages first, so
+the prompt plus the requested completion fits the model's token budget. Token
+counts come from the model's /tokenize endpoint and are cached per message.
+
+Session ids are generated here (secrets.token_urlsafe), never chosen by the
+client, so a history can only be read by whoever was given its id.
+
+Sessions are kept as JSON in a shared.py store, so with several workers a
+conversation continues whichever worker the next request lands on. Store
+access runs through store.run, off the event loop; a session's place in the
+LRU order is its last completed turn. A turn is appended with store.update,
+in one store transaction, so two turns finishing at once on the same session
+(in one worker or in two) are both kept.
+"""
+
+import json
+import time
+import secrets
+from typing import Optional
+
+# Rough allowance for the chat template's role markers around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class Session:
+    """Message history of one conversation."""
+
+    def __init__(self, session_id: str, max_messages: int):
+        self.id = session_id
+        self.max_messages = max_messages
+        self.messages = []
+        self.updated = time.time()
+
+    @classmethod
+    def load(cls, session_id: str, max_messages: int, data: str) -> "Session":
+        state = json.loads(data)
+        session = cls(session_id, max_messages)
+        session.messages = state["messages"]
+        session.updated = state["updated"]
+        return session
+
+    def dump(self) -> str:
+        return json.dumps({"messages": self.messages, "updated": self.updated})
+
+    def add_turn(self, user: dict, assistant: dict):
+        """Append a completed exchange; each message is {"role", "content", "tokens"}."""
+        self.messages.extend((user, assistant))
+        if len(self.messages) > self.max_messages:
+            # Drop whole turns so the history still starts with a user message
+            excess = len(self.messages) - self.max_messages
+            del self.messages[:excess + excess % 2]
+        self.updated = time.time()
+
+    def window(self, pending: dict, budget: int) -> tuple:
+        """
+        Pick the most recent history that fits `budget` tokens together with
+        the pending user message. Returns (messages, prompt_tokens, dropped).
+        The pending message is always included, even on its own over budget.
+        """
+        used = pending["tokens"] + MESSAGE_OVERHEAD_TOKENS
+        kept = 0
+        for message in reversed(self.messages):
+            cost = message["tokens"] + MESSAGE_OVERHEAD_TOKENS
+            if used + cost > budget:
+                break
+            used += cost
+            kept += 1
+        history = self.messages[len(self.messages) - kept:] if kept else []
+        # Don't open the conversation with an orphaned assistant reply
+        while history and history[0]["role"] == "assistant":
+            used -= history[0]["tokens"] + MESSAGE_OVERHEAD_TOKENS
+            history = history[1:]
+        messages = [{"role": m["role"], "content": m["content"]} for m in history]
+        messages.append({"role": pending["role"], "content": pending["content"]})
+        return messages, used, len(self.messages) - len(history)
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "messages": len(self.messages),
+            "tokens": sum(m["tokens"] for m in self.messages),
+            "idle": round(time.time() - self.updated, 1),
+        }
+
+
+class SessionStore:
+    """Sessions by id with least-recently-used eviction."""
+
+    _PREFIX = "session:"
+
+    def __init__(self, store, max_sessions: int = 1000, max_messages: int = 100):
+        self.store = store
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        return await self.store.run(self._load, session_id)
+
+    async def create(self) -> Session:
+        """Start a session under a new, unguessable id."""
+        return await self.store.run(self._load_or_create, secrets.token_urlsafe(18))
+
+    async def add_turn(self, session_id: str, user: dict, assistant: dict):
+        """Store a completed exchange, on top of any turn another request added meanwhile."""
+        await self.store.run(self._add_turn, session_id, user, assistant)
+
+    async def delete(self, session_id: str) -> bool:
+        return await self.store.run(self.store.delete, self._PREFIX + session_id)
+
+    async def stats(self) -> dict:
+        return await self.store.run(self._stats)
+
+    def _load(self, session_id: str) -> Optional[Session]:
+        data = self.store.get(self._PREFIX + session_id)
+        if data is None:
+            return None
+        return Session.load(session_id, self.max_messages, data)
+
+    def _load_or_create(self, session_id: str) -> Session:
+        session = self._load(session_id)
+        if session is None:
+            session = Session(session_id, self.max_messages)
+            self.store.set(self._PREFIX + session_id, session.dump())
+            self._evict()
+        return session
+
+    def _add_turn(self, session_id: str, user: dict, assistant: dict):
+        created = False
+
+        def append(data: Optional[str]) -> str:
+            nonlocal created
+            if data is None:
+                # Evicted or deleted since the turn started
+                created = True
+                session = Session(session_id, self.max_messages)
+            else:
+                session = Session.load(session_id, self.max_messages, data)
+            session.add_turn(user, assistant)
+            return session.dump()
+
+        self.store.update(self._PREFIX + session_id, append)
+        if created:
+            self._evict()
+
+    def _evict(self):
+        evicted = self.store.evict(self._PREFIX, self.max_sessions)
+        if evicted:
+            self.store.incr("sessions:evictions", evicted)
+
+    def _stats(self) -> dict:
+        histories = [json.loads(value)["messages"] for _, value in self.store.items(self._PREFIX)]
+        return {
+            "sessions": len(histories),
+            "max_sessions": self.max_sessions,
+            "messages": sum(len(messages) for messages in histories),
+            "evictions": self.store.counter("sessions:evictions"),
+        }
@@ -0,0 +1,307 @@
+"""
+State shared between worker processes.
+
+A single uvicorn process keeps everything in memory. With several workers
+(`uvicorn --workers N` or `gunicorn -w N -k uvicorn.workers.UvicornWorker`,
+both of which read WEB_CONCURRENCY) each process has its own event loop,
+upstream connections and JSON/streaming work, so throughput scales with
+cores; only the state that must be the same for every worker goes through
+the store selected by SHARED_STATE:
+
+    SHARED_STATE=memory                                 in-process (default)
+    SHARED_STATE=sqlite:////tmp/ai-orientation-state.db one file per pod
+
+That covers conversation sessions, the per-client queue limit and the
+metrics each worker publishes for /metrics. The store is a small key/value
+and counter interface; the SQLite file runs in WAL mode and every call is a
+single short statement or transaction. Request handling goes through
+`await store.run(method, ...)`, which keeps SQLite's disk I/O and lock waits
+on a thread instead of the event loop. Reads never write: keys are ordered
+for eviction by when they were last written.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import functools
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore:
+    """Key/value store local to this process."""
+
+    shared = False
+    name = "memory"
+
+    def __init__(self):
+        # key -> value, least recently written first
+        self._values: OrderedDict = OrderedDict()
+        # key -> (value, expires)
+        self._counters: dict = {}
+
+    async def run(self, method, *args):
+        """Call one of the store's methods; in memory that is instant, so inline."""
+        return method(*args)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._values.get(key)
+
+    def set(self, key: str, value: str):
+        self._values[key] = value
+        self._values.move_to_end(key)
+
+    def update(self, key: str, change) -> str:
+        """
+        Set key to change(current value, or None if unset) and return the new
+        value. Nothing else touches the key in between, so concurrent
+        read-modify-write cycles can't overwrite each other.
+        """
+        value = change(self._values.get(key))
+        self.set(key, value)
+        return value
+
+    def delete(self, key: str) -> bool:
+        return self._values.pop(key, None) is not None
+
+    def items(self, prefix: str) -> list:
+        return [(key, value) for key, value in self._values.items() if key.startswith(prefix)]
+
+    def count(self, prefix: str) -> int:
+        return sum(1 for key in self._values if key.startswith(prefix))
+
+    def evict(self, prefix: str, keep: int) -> int:
+        """Drop the least recently used keys under `prefix` beyond `keep`."""
+        keys = [key for key in self._values if key.startswith(prefix)]
+        for key in keys[:max(0, len(keys) - keep)]:
+            del self._values[key]
+        return max(0, len(keys) - keep)
+
+    def counter(self, key: str) -> int:
+        value, expires = self._counters.get(key, (0, None))
+        return 0 if expires is not None and expires < time.time() else value
+
+    def incr(self, key: str, amount: int = 1, limit: Optional[int] = None, ttl: Optional[float] = None) -> bool:
+        """
+        Add `amount` to a counter, never going below zero. An increment that
+        would take it past `limit` is refused and returns False. A counter not
+        changed for `ttl` seconds reads as zero again.
+        """
+        value = self.counter(key) + amount
+        if amount > 0 and limit is not None and value > limit:
+            return False
+        self._counters[key] = (max(0, value), time.time() + ttl if ttl else None)
+        return True
+
+    def close(self):
+        pass
+
+
+def _serialized(method):
+    # The store's threads share one connection, one call at a time
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SQLiteStore:
+    """Key/value store in a SQLite file shared by the workers of one host."""
+
+    shared = True
+
+    def __init__(self, path: str, timeout: float = 1.0):
+        self.path = path
+        self.name = f"sqlite:///{path}"
+        self.timeout = timeout
+        self._db = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    async def run(self, method, *args):
+        """Call one of the store's methods on a thread, off the event loop."""
+        return await asyncio.to_thread(method, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork (gunicorn --preload), so each
+        # process opens its own on first use
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS kv_updated ON kv (updated)")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL)")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    @staticmethod
+    def _range(prefix: str) -> tuple:
+        return prefix, prefix + "\U0010ffff"
+
+    @_serialized
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @_serialized
+    def set(self, key: str, value: str):
+        self._connection().execute(
+            "INSERT INTO kv (key, value, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+            (key, value, time.time()),
+        )
+
+    @_serialized
+    def update(self, key: str, change) -> str:
+        """Same semantics as MemoryStore.update, atomic across processes."""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            value = change(self.get(key))
+            self.set(key, value)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return value
+
+    @_serialized
+    def delete(self, key: str) -> bool:
+        return self._connection().execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount > 0
+
+    @_serialized
+    def items(self, prefix: str) -> list:
+        rows = self._connection().execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY updated", self._range(prefix))
+        return rows.fetchall()
+
+    @_serialized
+    def count(self, prefix: str) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM kv WHERE key >= ? AND key < ?", self._range(prefix)).fetchone()[0]
+
+    @_serialized
+    def evict(self, prefix: str, keep: int) -> int:
+        """Drop the least recently used keys under `prefix` beyond `keep`."""
+        return self._connection().execute(
+            "DELETE FROM kv WHERE key IN (SELECT key FROM kv WHERE key >= ? AND key < ? "
+            "ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+            (*self._range(prefix), keep),
+        ).rowcount
+
+    @_serialized
+    def counter(self, key: str) -> int:
+        row = self._connection().execute("SELECT value, expires FROM counters WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return 0
+        return row[0]
+
+    @_serialized
+    def incr(self, key: str, amount: int = 1, limit: Optional[int] = None, ttl: Optional[float] = None) -> bool:
+        """Same semantics as MemoryStore.incr, atomic across processes."""
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            value = self.counter(key) + amount
+            if amount > 0 and limit is not None and value > limit:
+                return False
+            db.execute(
+                "INSERT INTO counters (key, value, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires",
+                (key, max(0, value), time.time() + ttl if ttl else None),
+            )
+            return True
+        finally:
+            db.execute("COMMIT")
+
+    @_serialized
+    def close(self):
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+
+
+def open_store(url: str):
+    """Store for a SHARED_STATE setting: "memory" or "sqlite:///<path>"."""
+    if not url or url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported SHARED_STATE {url!r}; use 'memory' or 'sqlite:///<path>'")
+
+
+class WorkerMetrics:
+    """
+    Publishes this worker's metric values to the store on an interval so any
+    worker can answer /metrics for all of them. Counters and histograms are
+    additive, so the deployment-wide value is the sum over worker snapshots.
+    Snapshots are grouped by the parent process, i.e. one server run; those
+    of finished workers are kept so counters never go backwards, while those
+    of earlier runs are dropped at startup.
+    """
+
+    def __init__(self, store, registry, interval: float = 5.0):
+        self.store = store
+        self.registry = registry
+        self.interval = interval
+        # Set by start(): constructed at import time, this object may be forked
+        # into every worker (gunicorn --preload), so the pids are read later
+        self._prefix = None
+        self._key = None
+        self._task = None
+
+    def publish(self):
+        self.store.set(self._key, json.dumps(self.registry.snapshot()))
+
+    async def others(self) -> list:
+        """Latest snapshots of the other workers of this run."""
+        if not self.store.shared:
+            return []
+        items = await self.store.run(self.store.items, self._prefix)
+        return [json.loads(value) for key, value in items if key != self._key]
+
+    async def workers(self) -> int:
+        return await self.store.run(self.store.count, self._prefix) if self.store.shared else 1
+
+    def _drop_earlier_runs(self):
+        for key, _ in self.store.items("metrics:"):
+            if not key.startswith(self._prefix):
+                self.store.delete(key)
+
+    async def run(self):
+        try:
+            await self.store.run(self._drop_earlier_runs)
+        except sqlite3.Error:
+            logger.exception("Dropping earlier worker metrics failed")
+        while True:
+            try:
+                await self.store.run(self.publish)
+            except sqlite3.Error:
+                logger.exception("Publishing worker metrics failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Begin publishing; call from each worker once it is running."""
+        self._prefix = f"metrics:{os.getppid()}:"
+        self._key = f"{self._prefix}{os.getpid()}"
+        if not self.store.shared:
+            return
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            try:
+                await self.store.run(self.publish)
+            except sqlite3.Error:
+                logger.exception("Publishing worker metrics failed")
@@ -0,0 +1,146 @@
+"""
+Async stream plumbing for the chat proxy.
+
+merge_streams runs several model streams concurrently for /api/chat/compare
+and yields events as soon as any source produces one, with no polling.
+cancel_on_disconnect and call_until_disconnect stop upstream work as soon as
+the browser goes away, instead of draining the model until max_tokens.
+In every case, cancelling a source also closes its upstream HTTP stream.
+
+Sources run in their own tasks and hand items over through bounded queues, so
+a fast model waits for a slow reader instead of buffering its whole output.
+They are cancelled once and then waited for under a shielded cancel scope: the
+request's own cancellation (Starlette cancels the response when the client
+disconnects) must not interrupt them while they close their upstream streams.
+
+A source that raises is never swallowed: merge_streams re-raises the error to
+its consumer, and cancel_on_disconnect logs it and ends the response with an
+{"error": ...} event and [DONE], so the browser isn't left waiting.
+"""
+
+import asyncio
+import logging
+from contextlib import suppress
+
+import anyio
+
+from relay import DONE_EVENT, encode_event
+
+logger = logging.getLogger(__name__)
+
+_FINISHED = object()
+
+
+class _Failed:
+    """Queue marker carrying the exception a source raised."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+async def _pump(source, queue: asyncio.Queue):
+    """Put the items of an async generator on queue, then _FINISHED or _Failed."""
+    try:
+        async for item in source:
+            try:
+                await queue.put(item)
+            except asyncio.CancelledError:
+                # Cancelled while waiting for the reader, with the source parked
+                # at a yield: cancel it there so it closes its upstream stream
+                # exactly as if it had been cancelled mid-read
+                with suppress(asyncio.CancelledError, StopAsyncIteration):
+                    await source.athrow(asyncio.CancelledError())
+                await source.aclose()
+                raise
+    except Exception as e:
+        # CancelledError is not an Exception and passes through
+        await queue.put(_Failed(e))
+    else:
+        await queue.put(_FINISHED)
+
+
+async def _finish(*tasks):
+    """Wait for cancelled tasks to wind down, even if the caller is being cancelled."""
+    with anyio.CancelScope(shield=True):
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def merge_streams(sources: list):
+    """Yield items from all async generators in arrival order; re-raise the first source error."""
+    # Room for one item per source
+    queue = asyncio.Queue(maxsize=len(sources))
+    tasks = [asyncio.create_task(_pump(source, queue)) for source in sources]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            item = await queue.get()
+            if item is _FINISHED:
+                remaining -= 1
+                continue
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Pumps hand their errors over through the queue, so only cancellations are left here
+        await _finish(*tasks)
+
+
+async def wait_for_disconnect(receive):
+    """Return once the ASGI server reports that the client has gone away."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(receive, stream):
+    """Yield from an async generator until it ends, cancelling it if the client disconnects."""
+    queue = asyncio.Queue(maxsize=1)
+
+    async def watch():
+        await wait_for_disconnect(receive)
+        producer.cancel()
+        # Wake the consumer if the server doesn't cancel the response itself
+        await queue.put(_FINISHED)
+
+    producer = asyncio.create_task(_pump(stream, queue))
+    watcher = asyncio.create_task(watch())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _FINISHED:
+                break
+            if isinstance(item, _Failed):
+                logger.error("Streaming response failed", exc_info=item.error)
+                yield encode_event({"error": f"Stream failed: {item.error}"})
+                yield DONE_EVENT
+                break
+            yield item
+    finally:
+        watcher.cancel()
+        # The watcher may have cancelled the producer already; cancelling it
+        # again would interrupt it while it closes the upstream stream
+        if not producer.cancelling():
+            producer.cancel()
+        await _finish(producer, watcher)
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client went away before a non-streaming call finished."""
+
+
+async def call_until_disconnect(receive, awaitable):
+    """Await a result, cancelling the work if the client disconnects first."""
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if work.done():
+            return work.result()
+        raise ClientDisconnected()
+    finally:
+        work.cancel()
+        watcher.cancel()
+        await _finish(work, watcher)
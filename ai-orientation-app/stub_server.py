@@ -0,0 +1,257 @@
+"""
+Stub OpenAI-compatible model server for offline performance testing.
+
+Implements /v1/chat/completions (streaming and non-streaming), /tokenize,
+/detokenize, /v1/models and /health with a configurable token rate, time to
+first token, jitter and error injection, so the proxy can be exercised
+without vLLM:
+
+    python stub_server.py --port 8080 --token-rate 50 --ttft 0.2
+    MODEL_URL=http://localhost:8080 uvicorn main:app
+
+or in-process, without a network, via create_app() and httpx.ASGITransport.
+GET /stub/stats reports generations started, completed and cancelled, which
+makes the proxy's cancellation on client disconnect observable.
+
+Settings come from STUB_* environment variables or the matching flags.
+"""
+
+import os
+import re
+import time
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from relay import DONE_EVENT, encode_event
+
+# Reversible byte-level "tokenizer": a token is up to 4 bytes of text
+_TOKEN_PATTERN = re.compile(r"\s?[^\s]{1,3}|\s")
+_WORDS = (" The", " model", " is", " serving", " tokens", " from", " a", " stub", " server", ".")
+
+
+class StubConfig:
+    """Behaviour of the stub; every delay is in seconds."""
+
+    def __init__(
+        self,
+        token_rate: float = float(os.getenv("STUB_TOKEN_RATE", "50")),
+        ttft: float = float(os.getenv("STUB_TTFT", "0.2")),
+        prefill_rate: float = float(os.getenv("STUB_PREFILL_RATE", "0")),
+        jitter: float = float(os.getenv("STUB_JITTER", "0")),
+        output_tokens: int = int(os.getenv("STUB_OUTPUT_TOKENS", "0")),
+        error_rate: float = float(os.getenv("STUB_ERROR_RATE", "0")),
+        error_status: int = int(os.getenv("STUB_ERROR_STATUS", "503")),
+        abort_rate: float = float(os.getenv("STUB_ABORT_RATE", "0")),
+        seed: int = int(os.getenv("STUB_SEED", "0")),
+    ):
+        # Decode rate; 0 streams as fast as possible
+        self.token_rate = token_rate
+        self.ttft = ttft
+        # Extra TTFT per prompt token (prompt tokens / prefill_rate); 0 disables
+        self.prefill_rate = prefill_rate
+        # Each delay is scaled by a random factor in [1 - jitter, 1 + jitter]
+        self.jitter = jitter
+        # Tokens to generate per request; 0 means always generate max_tokens
+        self.output_tokens = output_tokens
+        # Fraction of requests answered with error_status
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Fraction of streams that drop the connection midway
+        self.abort_rate = abort_rate
+        self.seed = seed
+
+
+def tokenize(text: str) -> list:
+    return [int.from_bytes(piece.encode(), "big") for piece in _TOKEN_PATTERN.findall(text)]
+
+
+def detokenize(tokens: list) -> str:
+    pieces = []
+    for token in tokens:
+        length = max(1, (token.bit_length() + 7) // 8)
+        pieces.append(token.to_bytes(length, "big").decode(errors="replace"))
+    return "".join(pieces)
+
+
+def create_app(config: StubConfig = None) -> FastAPI:
+    config = config or StubConfig()
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "errors": 0, "started": 0, "completed": 0, "cancelled": 0, "aborted": 0, "tokens": 0}
+    app = FastAPI(title="Stub model server")
+
+    def jittered(delay: float) -> float:
+        if config.jitter and delay:
+            return delay * rng.uniform(1 - config.jitter, 1 + config.jitter)
+        return delay
+
+    def first_token_delay(prompt_tokens: int) -> float:
+        prefill = prompt_tokens / config.prefill_rate if config.prefill_rate else 0.0
+        return jittered(config.ttft + prefill)
+
+    def token_delay() -> float:
+        return jittered(1 / config.token_rate) if config.token_rate else 0.0
+
+    def prompt_length(messages: list) -> int:
+        return sum(len(tokenize(str(message.get("content") or ""))) for message in messages)
+
+    def completion_length(max_tokens: int) -> int:
+        return min(max_tokens, config.output_tokens) if config.output_tokens else max_tokens
+
+    def maybe_fail():
+        stats["requests"] += 1
+        if config.error_rate and rng.random() < config.error_rate:
+            stats["errors"] += 1
+            raise HTTPException(status_code=config.error_status, detail="Injected stub error")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy"}
+
+    @app.get("/v1/models")
+    async def models():
+        return {
+            "object": "list",
+            "data": [{"id": "stub", "object": "model", "owned_by": "stub", "max_model_len": 4096}],
+        }
+
+    @app.get("/stub/stats")
+    async def stub_stats():
+        return stats
+
+    @app.post("/tokenize")
+    async def tokenize_endpoint(request: Request):
+        body = await request.json()
+        maybe_fail()
+        tokens = tokenize(body.get("prompt", ""))
+        return {"tokens": tokens, "count": len(tokens), "max_model_len": 4096}
+
+    @app.post("/detokenize")
+    async def detokenize_endpoint(request: Request):
+        body = await request.json()
+        maybe_fail()
+        return {"prompt": detokenize(body.get("tokens", []))}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        maybe_fail()
+        model = body.get("model", "stub")
+        prompt_tokens = prompt_length(body.get("messages", []))
+        completion_tokens = completion_length(int(body.get("max_tokens") or 16))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        created = int(time.time())
+        completion_id = f"chatcmpl-stub-{stats['requests']}"
+
+        if not body.get("stream"):
+            stats["started"] += 1
+            await asyncio.sleep(first_token_delay(prompt_tokens) + token_delay() * (completion_tokens - 1))
+            stats["completed"] += 1
+            stats["tokens"] += completion_tokens
+            text = "".join(_WORDS[i % len(_WORDS)] for i in range(completion_tokens))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "length",
+                }],
+                "usage": usage,
+            }
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        abort_at = rng.randrange(completion_tokens) if config.abort_rate and rng.random() < config.abort_rate else None
+
+        def chunk(delta: dict, finish_reason=None) -> bytes:
+            return encode_event({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        async def generate():
+            stats["started"] += 1
+            generated = 0
+            try:
+                await asyncio.sleep(first_token_delay(prompt_tokens))
+                yield chunk({"role": "assistant", "content": ""})
+                for i in range(completion_tokens):
+                    if i:
+                        await asyncio.sleep(token_delay())
+                    if i == abort_at:
+                        stats["aborted"] += 1
+                        raise RuntimeError("Injected stub stream abort")
+                    yield chunk({"content": _WORDS[i % len(_WORDS)]})
+                    generated += 1
+                yield chunk({}, "length")
+                if include_usage:
+                    yield encode_event({
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [],
+                        "usage": usage,
+                    })
+                yield DONE_EVENT
+                stats["completed"] += 1
+            except asyncio.CancelledError:
+                stats["cancelled"] += 1
+                raise
+            finally:
+                stats["tokens"] += generated
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+app = create_app()
+
+
+def main(argv=None):
+    defaults = StubConfig()
+    parser = argparse.ArgumentParser(description="Stub OpenAI-compatible model server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate, help="tokens/s, 0 = unthrottled")
+    parser.add_argument("--ttft", type=float, default=defaults.ttft, help="seconds to the first token")
+    parser.add_argument("--prefill-rate", type=float, default=defaults.prefill_rate, help="prompt tokens/s added to TTFT")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="relative delay jitter, e.g. 0.2")
+    parser.add_argument("--output-tokens", type=int, default=defaults.output_tokens, help="cap on generated tokens")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--abort-rate", type=float, default=defaults.abort_rate, help="fraction of streams cut midway")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    config = StubConfig(
+        token_rate=args.token_rate,
+        ttft=args.ttft,
+        prefill_rate=args.prefill_rate,
+        jitter=args.jitter,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        abort_rate=args.abort_rate,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
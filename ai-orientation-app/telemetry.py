@@ -0,0 +1,287 @@
+"""
+Serving metrics for the chat proxy.
+
+A minimal Prometheus-compatible registry (counters and histograms rendered in
+the text exposition format) plus GenerationTimer, which measures one upstream
+generation: queue time, time to first token, inter-token latency, tokens per
+second and the upstream status. Each finished timer feeds the histograms and
+returns a summary that is also sent to the browser in the final SSE event.
+
+The model label is one of the configured model names (register_models);
+anything a client names in the playground is counted as "custom", so the
+number of series stays fixed whatever clients send.
+
+Metrics live in the worker process. With several workers, each one publishes
+Registry.snapshot() and renders the others' snapshots added to its own values
+(see shared.WorkerMetrics).
+"""
+
+import time
+from typing import Optional
+
+# Latency buckets in seconds, from sub-token gaps up to slow CPU generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500)
+
+# Label value for every model name that isn't configured
+CUSTOM_MODEL = "custom"
+_known_models: set = set()
+
+
+def register_models(*names: str):
+    """Give these model names their own label value."""
+    _known_models.update(names)
+
+
+def model_label(name: str) -> str:
+    """Label value for a model name: itself if configured, else CUSTOM_MODEL."""
+    return name if name in _known_models else CUSTOM_MODEL
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def total(self, snapshots: list = ()) -> float:
+        return sum(self.merged(snapshots).values())
+
+    def snapshot(self) -> list:
+        return [[list(key), value] for key, value in self._values.items()]
+
+    def merged(self, snapshots: list = ()) -> dict:
+        """Own values plus those in other workers' registry snapshots."""
+        values = dict(self._values)
+        for snapshot in snapshots:
+            for key, value in snapshot.get(self.name, ()):
+                key = tuple(key)
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def render(self, snapshots: list = ()) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self.merged(snapshots).items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: dict = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            series = [0] * (len(self.buckets) + 2)
+            self._values[key] = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def snapshot(self) -> list:
+        return [[list(key), series] for key, series in self._values.items()]
+
+    def merged(self, snapshots: list = ()) -> dict:
+        """Own series plus those in other workers' registry snapshots."""
+        values = {key: list(series) for key, series in self._values.items()}
+        for snapshot in snapshots:
+            for key, series in snapshot.get(self.name, ()):
+                # Skip snapshots taken with different buckets
+                if len(series) != len(self.buckets) + 2:
+                    continue
+                key = tuple(key)
+                if key in values:
+                    values[key] = [a + b for a, b in zip(values[key], series)]
+                else:
+                    values[key] = list(series)
+        return values
+
+    def render(self, snapshots: list = ()) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self.merged(snapshots).items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> dict:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def render(self, snapshots: list = ()) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(snapshots))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+QUEUE_TIME = registry.histogram(
+    "llm_proxy_queue_time_seconds", "Time spent waiting for an upstream slot.", ("model",))
+TIME_TO_FIRST_TOKEN = registry.histogram(
+    "llm_proxy_time_to_first_token_seconds", "Time from sending the upstream request to the first token.", ("model",))
+INTER_TOKEN_LATENCY = registry.histogram(
+    "llm_proxy_inter_token_latency_seconds", "Gap between consecutive streamed tokens.", ("model",))
+REQUEST_DURATION = registry.histogram(
+    "llm_proxy_upstream_duration_seconds", "Upstream generation time, first byte sent to last token.", ("model",))
+TOKENS_PER_SECOND = registry.histogram(
+    "llm_proxy_tokens_per_second", "Decode rate of each generation after the first token.", ("model",), RATE_BUCKETS)
+UPSTREAM_RESPONSES = registry.counter(
+    "llm_proxy_upstream_responses_total", "Upstream responses by status (or timeout/error).", ("model", "status"))
+GENERATED_TOKENS = registry.counter(
+    "llm_proxy_generated_tokens_total", "Tokens relayed from upstream models.", ("model",))
+CANCELLED_GENERATIONS = registry.counter(
+    "llm_proxy_cancelled_generations_total", "Generations cancelled because the client disconnected.", ("model",))
+TOKENS_SAVED = registry.counter(
+    "llm_proxy_tokens_saved_total", "Upper bound of tokens not generated thanks to cancellation.", ("model",))
+PREFIX_REQUESTS = registry.counter(
+    "llm_proxy_prefix_requests_total", "Playground requests with a fingerprinted system prompt.", ("model",))
+PREFIX_REUSED = registry.counter(
+    "llm_proxy_prefix_reused_total", "Requests whose system prompt the chosen replica served recently.", ("model",))
+
+
+def _percentile(ordered: list, percentile: float) -> Optional[float]:
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class GenerationTimer:
+    """Timing for one upstream generation."""
+
+    def __init__(self, model: str):
+        self.model = model_label(model)
+        self.created = time.perf_counter()
+        self.started: Optional[float] = None
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.queue_time = 0.0
+        self.tokens = 0
+        self.status: Optional[str] = None
+        self._gaps = []
+
+    def start(self):
+        """Mark the upstream request as sent (the queue wait is over)."""
+        self.started = time.perf_counter()
+        self.queue_time = self.started - self.created
+
+    def tokens_received(self, count: int = 1):
+        """Record `count` tokens arriving together, e.g. one batched relay read."""
+        if count <= 0:
+            return
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+            count_gaps = count - 1
+        else:
+            count_gaps = count
+        if count_gaps > 0:
+            # Spread the gap evenly over tokens that arrived in the same read
+            gap = (now - self.last_token) / count_gaps if self.last_token is not None else 0.0
+            self._gaps.extend([gap] * count_gaps)
+        self.last_token = now
+        self.tokens += count
+
+    def completed(self, tokens: int):
+        """Record a non-streaming response carrying `tokens` generated tokens."""
+        self.last_token = time.perf_counter()
+        self.tokens = tokens
+
+    def finish(self, status) -> dict:
+        """Record the outcome in the histograms and return the summary."""
+        self.status = str(status)
+        UPSTREAM_RESPONSES.inc(model=self.model, status=self.status)
+        summary = self.summary()
+        QUEUE_TIME.observe(self.queue_time, model=self.model)
+        if summary["ttft"] is not None:
+            TIME_TO_FIRST_TOKEN.observe(summary["ttft"], model=self.model)
+        if summary["duration"] is not None:
+            REQUEST_DURATION.observe(summary["duration"], model=self.model)
+        if summary["tokens_per_second"]:
+            TOKENS_PER_SECOND.observe(summary["tokens_per_second"], model=self.model)
+        for gap in self._gaps:
+            INTER_TOKEN_LATENCY.observe(gap, model=self.model)
+        if self.tokens:
+            GENERATED_TOKENS.inc(self.tokens, model=self.model)
+        return summary
+
+    def summary(self) -> dict:
+        ttft = self.first_token - self.started if self.first_token is not None and self.started else None
+        end = self.last_token or time.perf_counter()
+        duration = end - self.started if self.started else None
+        if self.first_token is not None:
+            decode_time = self.last_token - self.first_token
+            rate = (self.tokens - 1) / decode_time if decode_time > 0 else None
+        else:
+            # Non-streaming call: only the overall rate is known
+            rate = self.tokens / duration if self.tokens and duration else None
+        ordered = sorted(self._gaps)
+        return {
+            "queue_time": self.queue_time,
+            "ttft": ttft,
+            "duration": duration,
+            "tokens": self.tokens,
+            "tokens_per_second": rate,
+            "itl_p50": _percentile(ordered, 50),
+            "itl_p95": _percentile(ordered, 95),
+            "itl_p99": _percentile(ordered, 99),
+            "upstream_status": self.status,
+        }
+
+
+def record_cancellation(model: str, max_tokens: int, generated: int):
+    """Count an abandoned generation that was stopped before max_tokens."""
+    model = model_label(model)
+    CANCELLED_GENERATIONS.inc(model=model)
+    TOKENS_SAVED.inc(max(0, max_tokens - generated), model=model)
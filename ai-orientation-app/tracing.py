@@ -0,0 +1,192 @@
+"""
+OpenTelemetry tracing for the chat proxy.
+
+Tracing is enabled when OTEL_EXPORTER_OTLP_ENDPOINT is set (for example the
+lab's collector at http://trace-collector-collector:4318) and the
+opentelemetry packages are installed; otherwise every helper here is a no-op.
+
+Each /api/* request gets a server span and each upstream model call a child
+client span carrying the model name, prompt/completion token counts, TTFT and
+whether the generation was cancelled. The W3C traceparent header is forwarded
+to vLLM. Head sampling is a ratio (TRACE_SAMPLE_RATIO) with an optional cap on
+new traces per second (TRACE_MAX_PER_SECOND), so the overhead stays bounded.
+"""
+
+import os
+import time
+import threading
+import importlib.util
+
+try:
+    from opentelemetry import context as otel_context, propagate, trace
+    from opentelemetry.trace import SpanKind, StatusCode
+except ImportError:  # tracing is optional
+    trace = None
+
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+TRACE_MAX_PER_SECOND = float(os.getenv("TRACE_MAX_PER_SECOND", "0"))
+
+# Newer FastAPI releases open their own server spans once a tracer provider is
+# set; the middleware below then steps aside so requests aren't traced twice.
+FRAMEWORK_SERVER_SPANS = importlib.util.find_spec("fastapi.telemetry") is not None
+
+_tracer = None
+
+
+def setup_tracing(service_name: str) -> bool:
+    """Install the OTLP exporter and sampler. Returns True if tracing is active."""
+    global _tracer
+    if trace is None or not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return False
+
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    sampler = TraceIdRatioBased(TRACE_SAMPLE_RATIO)
+    if TRACE_MAX_PER_SECOND > 0:
+        sampler = _rate_limited(sampler, TRACE_MAX_PER_SECOND)
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", service_name)}),
+        sampler=ParentBased(sampler),
+    )
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("ai-orientation-app")
+    return True
+
+
+def shutdown_tracing():
+    """Flush buffered spans on shutdown."""
+    if _tracer is not None:
+        trace.get_tracer_provider().shutdown()
+
+
+def _rate_limited(sampler, per_second: float):
+    from opentelemetry.sdk.trace.sampling import Decision, Sampler, SamplingResult
+
+    class RateLimitedSampler(Sampler):
+        """Applies the ratio sampler, then drops new traces above a rate."""
+
+        def __init__(self):
+            self._lock = threading.Lock()
+            self._tokens = per_second
+            self._last = time.monotonic()
+
+        def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None):
+            result = sampler.should_sample(parent_context, trace_id, name, kind, attributes, links)
+            if not result.decision.is_sampled():
+                return result
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(per_second, self._tokens + (now - self._last) * per_second)
+                self._last = now
+                if self._tokens < 1:
+                    return SamplingResult(Decision.DROP)
+                self._tokens -= 1
+            return result
+
+        def get_description(self):
+            return f"RateLimited({per_second}/s, {sampler.get_description()})"
+
+    return RateLimitedSampler()
+
+
+class UpstreamSpan:
+    """
+    Client span for one upstream model call, mirroring GenerationTimer:
+    create it up front, start() it when the request is sent and finish() it
+    once. Does nothing when tracing is off.
+    """
+
+    def __init__(self, model_name: str, operation: str = "chat"):
+        self.model_name = model_name
+        self.operation = operation
+        self._span = None
+
+    def start(self, server_address: str):
+        if _tracer is not None:
+            self._span = _tracer.start_span(
+                f"{self.operation} {self.model_name}",
+                kind=SpanKind.CLIENT,
+                attributes={
+                    "gen_ai.operation.name": self.operation,
+                    "gen_ai.request.model": self.model_name,
+                    "server.address": server_address,
+                },
+            )
+
+    def headers(self) -> dict:
+        """W3C trace context headers to send upstream."""
+        if self._span is None:
+            return {}
+        carrier = {}
+        propagate.inject(carrier, context=trace.set_span_in_context(self._span))
+        return carrier
+
+    def finish(self, metrics: dict = None, usage: dict = None, cancelled: bool = False, error: str = None):
+        """Record the outcome and end the span; later calls are ignored."""
+        span, self._span = self._span, None
+        if span is None:
+            return
+        metrics = metrics or {}
+        usage = usage or {}
+        attributes = {
+            "gen_ai.usage.input_tokens": usage.get("prompt_tokens"),
+            "gen_ai.usage.output_tokens": usage.get("completion_tokens", metrics.get("tokens")),
+            "llm.time_to_first_token": metrics.get("ttft"),
+            "llm.tokens_per_second": metrics.get("tokens_per_second"),
+            "llm.queue_time": metrics.get("queue_time"),
+            "llm.upstream_status": metrics.get("upstream_status"),
+            "llm.cancelled": cancelled,
+        }
+        span.set_attributes({key: value for key, value in attributes.items() if value is not None})
+        if error:
+            span.set_status(StatusCode.ERROR, error)
+        span.end()
+
+
+class TracingMiddleware:
+    """ASGI middleware that opens a server span for each /api/* request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            _tracer is None
+            or FRAMEWORK_SERVER_SPANS
+            or scope["type"] != "http"
+            or not scope["path"].startswith("/api/")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        parent = propagate.extract(headers)
+        span = _tracer.start_span(
+            f"{scope['method']} {scope['path']}",
+            context=parent,
+            kind=SpanKind.SERVER,
+            attributes={"http.request.method": scope["method"], "url.path": scope["path"]},
+        )
+        token = otel_context.attach(trace.set_span_in_context(span, parent))
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                span.set_attribute("http.response.status_code", message["status"])
+                if message["status"] >= 500:
+                    span.set_status(StatusCode.ERROR)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(StatusCode.ERROR, str(e))
+            raise
+        finally:
+            span.end()
+            otel_context.detach(token)
@@ -0,0 +1,250 @@
+"""
+Client-side load balancing across model replicas.
+
+A model URL setting may hold several comma-separated endpoints, e.g.
+MODEL_URL="http://llama-0:8080,http://llama-1:8080". Each logical model becomes
+a ModelPool that picks an endpoint per request (least outstanding requests or
+power-of-two-choices), tracks per-endpoint latency, and temporarily ejects
+endpoints that keep failing or timing out. Endpoints of the configured models
+that the background health probe (discovery.py) reports down are skipped;
+URLs a client names (the playground's model_url) are never probed, and only
+the most recently used few keep a pool. Requests may carry an affinity key
+(e.g. a prompt prefix fingerprint); those go to the same replica via
+rendezvous hashing unless it is noticeably busier than the others.
+"""
+
+import time
+import random
+import hashlib
+from collections import OrderedDict, deque
+from typing import Optional
+
+import httpx
+
+LEAST_OUTSTANDING = "least_outstanding"
+POWER_OF_TWO = "p2c"
+
+
+def parse_endpoints(model_url: str) -> list:
+    """Split a comma-separated model URL setting into endpoint base URLs."""
+    return [url.strip().rstrip("/") for url in model_url.split(",") if url.strip()]
+
+
+class Endpoint:
+    """One upstream replica and its health and latency state."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.ewma_latency: Optional[float] = None
+        self._latencies = deque(maxlen=200)
+        # Set by the health probe; None until the first probe completes
+        self.healthy: Optional[bool] = None
+        self.probe_error: Optional[str] = None
+        self.models: list = []
+        self.max_model_len: Optional[int] = None
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until and self.healthy is not False
+
+    def record_success(self, latency: float):
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self._latencies.append(latency)
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = 0.8 * self.ewma_latency + 0.2 * latency
+
+    def record_failure(self, eject_after: int, eject_seconds: float):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= eject_after:
+            # Back off exponentially while the replica keeps failing
+            self.ejected_until = time.monotonic() + eject_seconds * (2 ** min(self.ejections, 4))
+            self.ejections += 1
+            self.consecutive_failures = 0
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "url": self.url,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected": not self.available(now),
+            "ejected_for": max(0.0, round(self.ejected_until - now, 1)),
+            "latency_ewma": self.ewma_latency,
+            "latency_p50": self.latency_percentile(50),
+            "latency_p95": self.latency_percentile(95),
+            "healthy": self.healthy,
+            "probe_error": self.probe_error,
+            "models": self.models,
+            "max_model_len": self.max_model_len,
+        }
+
+
+class Lease:
+    """An in-flight request against one endpoint."""
+
+    def __init__(self, pool: "ModelPool", endpoint: Endpoint):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.started = time.monotonic()
+        self._reported = False
+
+    @property
+    def url(self) -> str:
+        return self.endpoint.url
+
+    def success(self):
+        """Record the endpoint as healthy, using the time since the lease started."""
+        if not self._reported:
+            self._reported = True
+            self.endpoint.record_success(time.monotonic() - self.started)
+
+    def failure(self):
+        """Record an error or timeout against the endpoint."""
+        if not self._reported:
+            self._reported = True
+            self.endpoint.record_failure(self.pool.eject_after, self.pool.eject_seconds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.endpoint.outstanding -= 1
+        if isinstance(exc, httpx.RequestError):
+            self.failure()
+        return False
+
+
+class ModelPool:
+    """The set of replicas serving one logical model."""
+
+    def __init__(self, urls: list, strategy: str, eject_after: int, eject_seconds: float, affinity_slack: int = 2):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.affinity_slack = affinity_slack
+
+    def pick(self, affinity: Optional[str] = None) -> Endpoint:
+        """Choose the endpoint for the next request."""
+        if len(self.endpoints) == 1:
+            return self.endpoints[0]
+        now = time.monotonic()
+        candidates = [ep for ep in self.endpoints if ep.available(now)]
+        if not candidates:
+            # Everything is ejected or down: fail open on the replica that recovers first
+            return min(self.endpoints, key=lambda ep: ep.ejected_until)
+        if affinity is not None:
+            preferred = max(candidates, key=lambda ep: _affinity_score(ep.url, affinity))
+            least = min(ep.outstanding for ep in candidates)
+            # Stick to the replica holding the cached prefix unless it is overloaded
+            if preferred.outstanding <= least + self.affinity_slack:
+                return preferred
+        if self.strategy == POWER_OF_TWO and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=_load_key)
+
+    def acquire(self, affinity: Optional[str] = None) -> Lease:
+        """Pick an endpoint and count a request against it until the lease exits."""
+        endpoint = self.pick(affinity)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return Lease(self, endpoint)
+
+    def down(self) -> bool:
+        """True when the health probe reports every replica down."""
+        return all(endpoint.healthy is False for endpoint in self.endpoints)
+
+    def stats(self) -> list:
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+
+def _load_key(endpoint: Endpoint):
+    # Fewest in-flight requests first, then the faster replica, then random
+    latency = endpoint.ewma_latency if endpoint.ewma_latency is not None else 0.0
+    return (endpoint.outstanding, latency, random.random())
+
+
+def _affinity_score(url: str, key: str) -> int:
+    # Rendezvous hashing: every key has a stable replica ranking, and removing a
+    # replica only moves the keys that were on it
+    return int.from_bytes(hashlib.blake2b(f"{key}|{url}".encode(), digest_size=8).digest(), "big")
+
+
+class UpstreamRegistry:
+    """Maps model URL settings to their ModelPool."""
+
+    def __init__(
+        self,
+        strategy: str = LEAST_OUTSTANDING,
+        eject_after: int = 3,
+        eject_seconds: float = 30.0,
+        affinity_slack: int = 2,
+        max_custom: int = 16,
+    ):
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.affinity_slack = affinity_slack
+        # Client-supplied URLs kept at once; idle ones are dropped least recently used first
+        self.max_custom = max_custom
+        self._pools: "OrderedDict[str, ModelPool]" = OrderedDict()
+        # Model URL settings from the app's configuration, as opposed to client-supplied ones
+        self._configured: set = set()
+
+    def configure(self, model_url: str) -> ModelPool:
+        """Register a configured model, so it is probed and reported."""
+        self._configured.add(model_url)
+        return self.get(model_url)
+
+    def get(self, model_url: str) -> ModelPool:
+        pool = self._pools.get(model_url)
+        if pool is None:
+            pool = ModelPool(
+                parse_endpoints(model_url) or [model_url],
+                self.strategy,
+                self.eject_after,
+                self.eject_seconds,
+                self.affinity_slack,
+            )
+            self._pools[model_url] = pool
+            if model_url not in self._configured:
+                self._evict_custom()
+        elif model_url not in self._configured:
+            self._pools.move_to_end(model_url)
+        return pool
+
+    def _evict_custom(self):
+        custom = [key for key in self._pools if key not in self._configured]
+        excess = len(custom) - self.max_custom
+        for key in custom:
+            if excess <= 0:
+                break
+            # A pool with requests in flight is kept until they finish
+            if not any(endpoint.outstanding for endpoint in self._pools[key].endpoints):
+                del self._pools[key]
+                excess -= 1
+
+    def pools(self) -> list:
+        """(model URL setting, pool) pairs of the configured models."""
+        return [(key, pool) for key, pool in self._pools.items() if key in self._configured]
+
+    def stats(self) -> dict:
+        return {key: pool.stats() for key, pool in self._pools.items()}
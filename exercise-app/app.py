@@ -1,16 +1,19 @@
 import os
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+from assets import AssetStore
+
 app = FastAPI(title="AI Orientation Exercises")
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Static files are precompressed and served from memory; templates link to
+# fingerprinted URLs so browsers can cache them for good
+assets = AssetStore("static")
 
 # Setup templates
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["asset_url"] = assets.url
 
 # Get AI orientation app URL from environment variable
 AI_ORIENTATION_APP_URL = os.getenv("AI_ORIENTATION_APP_URL", "http://localhost:8000")
@@ -80,6 +83,11 @@ async def home(request: Request):
     )
 
 
+@app.api_route("/static/{name:path}", methods=["GET", "HEAD"])
+async def static_asset(name: str, request: Request):
+    return assets.response(request, name)
+
+
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
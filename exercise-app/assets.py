@@ -0,0 +1,84 @@
+"""
+The exercise app's static files, served from memory.
+
+The app only has a stylesheet, so each file under static/ is read and
+gzip-compressed once at startup. Templates link to it through a fingerprinted
+name (styles.1a2b3c4d.css) that browsers cache for a year; the plain name is
+served with no-cache and a matching If-None-Match answers 304.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path, PurePosixPath
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def _accepts_gzip(header: str) -> bool:
+    for part in header.lower().split(","):
+        coding, _, quality = part.partition(";")
+        if coding.strip() == "gzip":
+            quality = quality.strip()
+            try:
+                return not quality.startswith("q=") or float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+class AssetStore:
+    """All files under a directory, by plain and fingerprinted name."""
+
+    def __init__(self, directory):
+        # name -> (tag, media type, body, gzipped body or None if no smaller)
+        self._files = {}
+        # fingerprinted name -> name, and back
+        self._names = {}
+        self._fingerprinted = {}
+        for path in sorted(Path(directory).rglob("*")):
+            if not path.is_file():
+                continue
+            name = path.relative_to(directory).as_posix()
+            data = path.read_bytes()
+            tag = hashlib.sha256(data).hexdigest()[:16]
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if media_type.startswith("text/"):
+                media_type += "; charset=utf-8"
+            gzipped = gzip.compress(data, 9, mtime=0)
+            self._files[name] = (tag, media_type, data, gzipped if len(gzipped) < len(data) else None)
+            plain = PurePosixPath(name)
+            fingerprinted = str(plain.with_name(f"{plain.stem}.{tag[:8]}{plain.suffix}"))
+            self._names[fingerprinted] = name
+            self._fingerprinted[name] = fingerprinted
+
+    def url(self, name: str) -> str:
+        """Fingerprinted URL of a file, for long-lived caching."""
+        return f"/static/{self._fingerprinted[name]}"
+
+    def response(self, request: Request, name: str) -> Response:
+        immutable = name in self._names
+        name = self._names.get(name, name)
+        if name not in self._files:
+            return Response(status_code=404)
+        tag, media_type, data, gzipped = self._files[name]
+
+        compress = gzipped is not None and _accepts_gzip(request.headers.get("accept-encoding", ""))
+        headers = {
+            "ETag": f'"{tag}-gzip"' if compress else f'"{tag}"',
+            "Cache-Control": IMMUTABLE if immutable else REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+        # Either encoding's ETag names the same content
+        for candidate in request.headers.get("if-none-match", "").split(","):
+            candidate = candidate.strip().removeprefix("W/").strip('"')
+            if candidate == "*" or candidate.split("-")[0] == tag:
+                return Response(status_code=304, headers=headers)
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+            return Response(gzipped, media_type=media_type, headers=headers)
+        return Response(data, media_type=media_type, headers=headers)
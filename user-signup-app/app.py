@@ -1,8 +1,19 @@
+import io
 import os
-import sqlite3
 import re
+import csv
+import hmac
+import json
+import math
+import time
+import heapq
+import threading
+from collections import Counter
 from flask import Flask, render_template, request, jsonify, Response
-from datetime import datetime
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, timedelta, timezone
+from db import Database
+from ratelimit import TokenBucketLimiter
 
 app = Flask(__name__)
 
@@ -13,105 +24,568 @@ MAX_USERS = int(os.getenv('MAX_USERS', '25'))
 LAB_INSTRUCTIONS_URL = os.getenv('LAB_INSTRUCTIONS_URL', 'https://rhoai-genaiops.github.io/lab-instructions/')
 DB_PATH = os.getenv('DB_PATH', '/data/users.db')
 ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', 'admin-secret-token-change-me')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '5'))
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '5'))
+# JSON list of slot pools; without it there is one pool built from the settings above
+POOLS_FILE = os.getenv('POOLS_FILE')
+DEFAULT_POOL = 'default'
+# Hours an assignment lasts before its slot is reclaimed (0: never), unless a pool sets its own
+LEASE_HOURS = float(os.getenv('LEASE_HOURS', '0'))
+# Seconds between sweeps for expired leases, and assignments released per transaction
+SWEEP_INTERVAL = float(os.getenv('SWEEP_INTERVAL', '60'))
+SWEEP_BATCH = 500
+
+# /admin/users page size, and rows fetched per CSV chunk in /admin/export
+ADMIN_PAGE_SIZE = 100
+ADMIN_MAX_PAGE_SIZE = 1000
+EXPORT_BATCH_ROWS = 500
+
+# /admin/preregister: largest list accepted, and emails per IN (...) lookup
+BULK_MAX_EMAILS = int(os.getenv('BULK_MAX_EMAILS', '10000'))
+BULK_QUERY_CHUNK = 500
+
+# Signup rate limits: a burst of requests, then a steady rate per second (a burst of 0 turns a limit off;
+# the rate of a limit that is on must be positive).
+# Per client IP, sized for a classroom behind one NAT address, and per email address.
+SIGNUP_IP_BURST = float(os.getenv('SIGNUP_IP_BURST', '100'))
+SIGNUP_IP_RATE = float(os.getenv('SIGNUP_IP_RATE', '2'))
+SIGNUP_EMAIL_BURST = float(os.getenv('SIGNUP_EMAIL_BURST', '5'))
+SIGNUP_EMAIL_RATE = float(os.getenv('SIGNUP_EMAIL_RATE', '0.1'))
+# Wrong admin tokens an IP may send before /admin/* locks it out; one more is allowed per minute
+ADMIN_MAX_FAILURES = float(os.getenv('ADMIN_MAX_FAILURES', '10'))
+# Clients tracked per limit; the least recently seen are forgotten first
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '10000'))
+# Reverse proxies in front of the app whose X-Forwarded-For is trusted for the client IP
+PROXY_COUNT = int(os.getenv('PROXY_COUNT', '0'))
+# Limits are kept per process, so each gunicorn worker gets its share
+WORKERS = max(int(os.getenv('WEB_CONCURRENCY', '1')), 1)
+
+if PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
+db = Database(DB_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT, DB_SYNCHRONOUS)
+
+def rate_limiter(burst, rate, setting):
+    """This worker's share of a limit, or None when the limit is off"""
+    if burst <= 0:
+        return None
+    if rate <= 0:
+        raise ValueError(f'{setting} must be positive while its limit is on, got {rate}')
+    return TokenBucketLimiter(burst / WORKERS, rate / WORKERS, RATE_LIMIT_MAX_KEYS)
+
+signup_ip_limiter = rate_limiter(SIGNUP_IP_BURST, SIGNUP_IP_RATE, 'SIGNUP_IP_RATE')
+signup_email_limiter = rate_limiter(SIGNUP_EMAIL_BURST, SIGNUP_EMAIL_RATE, 'SIGNUP_EMAIL_RATE')
+admin_failure_limiter = rate_limiter(ADMIN_MAX_FAILURES, 1 / 60, 'admin failure refill')
+
+class AssignmentCounter:
+    """Number of assigned slots, kept in memory for the landing page and /stats.
+
+    Signups handled by this process update it directly. It is re-read from the
+    database at startup and whenever it is older than `ttl` seconds, which
+    picks up assignments made by other processes or directly in the database.
+    `capacity` is the total size of the active pools as of the last read.
+
+    The same read caches each pool's part of the signup response, so a
+    signup doesn't query the pools table.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._count = None
+        self._loaded_at = 0.0
+        self.capacity = 0
+        self.templates = {}
+        self.pool_ids = {}
+
+    def load(self):
+        """Reconcile with the database"""
+        with db.connection() as conn:
+            pools = conn.execute('SELECT * FROM pools').fetchall()
+        active = [pool for pool in pools if pool['active']]
+        with self._lock:
+            self._count = sum(pool['assigned'] for pool in active)
+            self.capacity = sum(pool['size'] for pool in active)
+            self.templates = {pool['id']: response_template(pool) for pool in pools}
+            self.pool_ids = {pool['name']: pool['id'] for pool in active}
+            self._loaded_at = time.monotonic()
+        return self._count
+
+    def template(self, pool_id):
+        """Signup response fields shared by everyone in a pool"""
+        template = self.templates.get(pool_id)
+        if template is None:
+            # A pool created by another process since the last read
+            self.load()
+            template = self.templates[pool_id]
+        return template
+
+    def pool_id(self, name):
+        """Id of the active pool with this name, or None"""
+        if name not in self.pool_ids:
+            self.load()
+        return self.pool_ids.get(name)
+
+    def get(self):
+        if self._count is None or time.monotonic() - self._loaded_at > self.ttl:
+            return self.load()
+        return self._count
+
+    def add(self, amount=1):
+        with self._lock:
+            if self._count is not None:
+                self._count += amount
+
+def response_template(pool):
+    """The part of a signup response that is the same for every user of a pool"""
+    return {
+        'password': pool['password'],
+        'cluster_domain': pool['cluster_domain'],
+        'pool': pool['name'],
+        'lab_url': pool['lab_url'],
+        'instructions': f"Access the lab instructions at {pool['lab_url']} and use your credentials to log into the cluster."
+    }
+
+assignments = AssignmentCounter(STATS_CACHE_TTL)
+
+# Rendered landing page and /stats body for the current count: ((count, capacity), content)
+_page_cache = (None, None)
+_stats_cache = (None, None, None)
 
 def init_db():
-    """Initialize the database with users table"""
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    """Initialize the database with the pools and users tables"""
+    os.makedirs(os.path.dirname(DB_PATH) or '.', exist_ok=True)
+    pools = load_pool_config()
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        create_schema(cursor)
+        sync_pools(cursor, pools)
+    assignments.load()
+
+def create_schema(cursor):
+    """Create the tables, migrating a database from before slot pools"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_assignments (
+        CREATE TABLE IF NOT EXISTS pools (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            username TEXT UNIQUE NOT NULL,
-            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            name TEXT UNIQUE NOT NULL,
+            cluster_domain TEXT NOT NULL,
+            password TEXT NOT NULL,
+            username_prefix TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            lab_url TEXT NOT NULL,
+            lease_hours REAL NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1,
+            assigned INTEGER NOT NULL DEFAULT 0
         )
     ''')
-    conn.commit()
-    conn.close()
+    if 'lease_hours' not in [row['name'] for row in cursor.execute('PRAGMA table_info(pools)')]:
+        cursor.execute('ALTER TABLE pools ADD COLUMN lease_hours REAL NOT NULL DEFAULT 0')
 
-def get_db_connection():
-    """Get a database connection"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(user_assignments)')]
+    if columns and 'pool_id' not in columns:
+        # Single-pool database: its users become the default pool's
+        cursor.execute('ALTER TABLE user_assignments RENAME TO user_assignments_old')
+        cursor.execute('DROP TABLE IF EXISTS free_slots')
 
-def validate_email(email):
-    """Basic email validation"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
-
-def get_next_available_user():
-    """Find the next available user from user1 to user{MAX_USERS}"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get all assigned usernames
-    cursor.execute('SELECT username FROM user_assignments')
-    assigned_users = set(row['username'] for row in cursor.fetchall())
-    conn.close()
+    # A slot is a pool's username number; usernames repeat across pools (clusters)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_assignments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            pool_id INTEGER NOT NULL REFERENCES pools (id),
+            slot INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP,
+            UNIQUE (pool_id, slot)
+        )
+    ''')
+    if columns and 'expires_at' not in columns and 'pool_id' in columns:
+        cursor.execute('ALTER TABLE user_assignments ADD COLUMN expires_at TIMESTAMP')
+    cursor.execute('CREATE INDEX IF NOT EXISTS user_assignments_username ON user_assignments (username)')
+    # The sweeper finds expired leases through this; assignments without a lease aren't in it
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS user_assignments_expires
+        ON user_assignments (expires_at) WHERE expires_at IS NOT NULL
+    ''')
+    # Slot numbers not yet assigned, per pool; the lowest one is claimed via the primary key index
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS free_slots (
+            pool_id INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            PRIMARY KEY (pool_id, number)
+        ) WITHOUT ROWID
+    ''')
 
-    # Find first available user
-    for i in range(1, MAX_USERS + 1):
-        username = f'user{i}'
-        if username not in assigned_users:
-            return username
+    if columns and 'pool_id' not in columns:
+        pool_id = save_pool(cursor, default_pool(), sync=False)
+        cursor.execute('''
+            INSERT INTO user_assignments (id, email, pool_id, slot, username, assigned_at)
+            SELECT id, email, ?, CAST(substr(username, 5) AS INTEGER), username, assigned_at
+            FROM user_assignments_old
+        ''', (pool_id,))
+        cursor.execute('DROP TABLE user_assignments_old')
+
+    # Assigning a slot takes it off the free list and counts it in its pool;
+    # releasing one puts it back, unless the pool has shrunk below it or is retired.
+    # Every way of adding or removing assignments goes through these.
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS assignment_takes_slot
+        AFTER INSERT ON user_assignments
+        BEGIN
+            DELETE FROM free_slots WHERE pool_id = NEW.pool_id AND number = NEW.slot;
+            UPDATE pools SET assigned = assigned + 1 WHERE id = NEW.pool_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS assignment_frees_slot
+        AFTER DELETE ON user_assignments
+        BEGIN
+            INSERT OR IGNORE INTO free_slots (pool_id, number)
+            SELECT id, OLD.slot FROM pools WHERE id = OLD.pool_id AND active AND size >= OLD.slot;
+            UPDATE pools SET assigned = assigned - 1 WHERE id = OLD.pool_id;
+        END
+    ''')
 
-    return None
+def default_pool():
+    """The single pool described by CLUSTER_DOMAIN, USER_PASSWORD, MAX_USERS and LAB_INSTRUCTIONS_URL"""
+    return pool_settings({'name': DEFAULT_POOL, 'size': MAX_USERS})
+
+def load_pool_config():
+    """Pool settings from POOLS_FILE, or just the default pool"""
+    if not POOLS_FILE:
+        return [default_pool()]
+    with open(POOLS_FILE) as f:
+        pools = json.load(f)
+    if not isinstance(pools, list):
+        raise ValueError(f'{POOLS_FILE} must contain a JSON list of pools')
+    return [pool_settings(pool) for pool in pools]
+
+def pool_settings(data):
+    """Validated pool fields; anything not given falls back to the app-wide setting.
+
+    Raises ValueError with a message suitable for the API caller.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('A pool must be a JSON object')
+    name = str(data.get('name') or '').strip()
+    if not name:
+        raise ValueError('Pool name is required')
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        raise ValueError(f'Pool {name}: size must be an integer') from None
+    if size < 0:
+        raise ValueError(f'Pool {name}: size must not be negative')
+    prefix = str(data.get('username_prefix') or 'user')
+    if not re.fullmatch(r'[A-Za-z][A-Za-z0-9._-]*', prefix):
+        raise ValueError(f'Pool {name}: username_prefix may only contain letters, digits, ".", "_" and "-"')
+    try:
+        lease_hours = float(LEASE_HOURS if data.get('lease_hours') is None else data['lease_hours'])
+    except (TypeError, ValueError):
+        raise ValueError(f'Pool {name}: lease_hours must be a number') from None
+    if lease_hours < 0:
+        raise ValueError(f'Pool {name}: lease_hours must not be negative')
+
+    return {
+        'name': name,
+        'size': size,
+        'username_prefix': prefix,
+        'cluster_domain': str(data.get('cluster_domain') or CLUSTER_DOMAIN),
+        'password': str(data.get('password') or USER_PASSWORD),
+        'lab_url': str(data.get('lab_url') or LAB_INSTRUCTIONS_URL),
+        'lease_hours': lease_hours
+    }
 
-def assign_user(email):
-    """Assign a user to an email address"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def sync_pools(cursor, pools):
+    """Create or update the configured pools and rebuild their free slot lists.
+
+    With POOLS_FILE the file is the full list: pools missing from it stop
+    taking signups (their users are kept). Without it only the default pool
+    is updated, and pools added through /admin/pools are left alone.
+    """
+    for pool in pools:
+        save_pool(cursor, pool)
+    if POOLS_FILE:
+        names = [pool['name'] for pool in pools]
+        cursor.execute(
+            f"UPDATE pools SET active = 0 WHERE name NOT IN ({','.join('?' * len(names))})",
+            names
+        )
+        cursor.execute('DELETE FROM free_slots WHERE pool_id IN (SELECT id FROM pools WHERE NOT active)')
 
-    try:
-        # Check if email already has an assignment
-        cursor.execute('SELECT username FROM user_assignments WHERE email = ?', (email,))
-        existing = cursor.fetchone()
+def save_pool(cursor, pool, sync=True):
+    """Insert or update a pool by name and (re)activate it; returns its id.
 
-        if existing:
-            conn.close()
-            return existing['username']
+    Raises ValueError if another pool hands out the same usernames on the same cluster.
+    """
+    cursor.execute(
+        'SELECT name FROM pools WHERE cluster_domain = ? AND username_prefix = ? AND name != ?',
+        (pool['cluster_domain'], pool['username_prefix'], pool['name'])
+    )
+    clash = cursor.fetchone()
+    if clash:
+        raise ValueError(
+            f"Pool {pool['name']}: pool {clash['name']} already uses "
+            f"{pool['username_prefix']}N usernames on {pool['cluster_domain']}"
+        )
+    cursor.execute('''
+        INSERT INTO pools (name, cluster_domain, password, username_prefix, size, lab_url, lease_hours, active)
+        VALUES (:name, :cluster_domain, :password, :username_prefix, :size, :lab_url, :lease_hours, 1)
+        ON CONFLICT (name) DO UPDATE SET
+            cluster_domain = excluded.cluster_domain,
+            password = excluded.password,
+            username_prefix = excluded.username_prefix,
+            size = excluded.size,
+            lab_url = excluded.lab_url,
+            lease_hours = excluded.lease_hours,
+            active = 1
+        RETURNING id
+    ''', pool)
+    pool_id = cursor.fetchone()['id']
+    if sync:
+        sync_free_slots(cursor, pool_id, pool['size'])
+    return pool_id
+
+def sync_free_slots(cursor, pool_id, size):
+    """Rebuild a pool's free slot list and count from its assignments (its size may have changed)"""
+    cursor.execute('SELECT slot FROM user_assignments WHERE pool_id = ?', (pool_id,))
+    assigned = {row['slot'] for row in cursor.fetchall()}
+
+    cursor.execute('DELETE FROM free_slots WHERE pool_id = ?', (pool_id,))
+    cursor.executemany(
+        'INSERT INTO free_slots (pool_id, number) VALUES (?, ?)',
+        ((pool_id, i) for i in range(1, size + 1) if i not in assigned)
+    )
+    cursor.execute('UPDATE pools SET assigned = ? WHERE id = ?', (len(assigned), pool_id))
 
-        # Get next available user
-        username = get_next_available_user()
+def lease_expiry(pool):
+    """When an assignment made or renewed now in this pool expires, as stored in the database, or None"""
+    if not pool['lease_hours']:
+        return None
+    expires = datetime.now(timezone.utc) + timedelta(hours=pool['lease_hours'])
+    return expires.strftime('%Y-%m-%d %H:%M:%S')
 
-        if username is None:
-            conn.close()
-            return None
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
-        # Assign the user
-        cursor.execute(
-            'INSERT INTO user_assignments (email, username) VALUES (?, ?)',
-            (email, username)
+def validate_email(email):
+    """Basic email validation"""
+    return EMAIL_PATTERN.match(email) is not None
+
+# Lease end for an assignment made or renewed now, in SQL; NULL when the pool has no lease
+LEASE_EXPIRY_SQL = "datetime('now', '+' || CAST(lease_hours * 3600 AS INTEGER) || ' seconds')"
+
+def assign_user(email, pool_id=None):
+    """Assign a user to an email address; returns (username, pool id, expires_at) or None when full"""
+    # One statement does the whole signup: it picks the least-loaded pool with
+    # room (or the given one) and its lowest free slot, and inserts the
+    # assignment; the assignment_takes_slot trigger removes the slot from the
+    # free list. An email that already has a user hits the conflict instead,
+    # which renews its lease and returns the existing row. A single statement
+    # holds the write lock from start to end, so concurrent signups can't take
+    # the same slot.
+    with db.connection() as conn:
+        changes = conn.total_changes
+        row = conn.execute(f'''
+            INSERT INTO user_assignments (email, pool_id, slot, username, expires_at)
+            SELECT :email, pool.id, free.number, pool.username_prefix || free.number,
+                   CASE WHEN pool.lease_hours > 0 THEN {LEASE_EXPIRY_SQL} END
+            FROM (
+                SELECT * FROM pools
+                WHERE active AND assigned < size AND (:pool_id IS NULL OR id = :pool_id)
+                ORDER BY CAST(assigned AS REAL) / size, id
+                LIMIT 1
+            ) AS pool
+            JOIN free_slots AS free
+                ON free.pool_id = pool.id
+                AND free.number = (SELECT MIN(number) FROM free_slots WHERE pool_id = pool.id)
+            WHERE true
+            ON CONFLICT (email) DO UPDATE SET expires_at = (
+                SELECT CASE WHEN lease_hours > 0 THEN {LEASE_EXPIRY_SQL} ELSE user_assignments.expires_at END
+                FROM pools WHERE id = user_assignments.pool_id
+            )
+            RETURNING username, pool_id, expires_at
+        ''', {'email': email, 'pool_id': pool_id}).fetchone()
+
+        if row is None:
+            # No room anywhere, so nothing was inserted and no conflict came up:
+            # an email that already has a user still gets it (and a renewed lease)
+            row = conn.execute(f'''
+                UPDATE user_assignments SET expires_at = (
+                    SELECT CASE WHEN lease_hours > 0 THEN {LEASE_EXPIRY_SQL} ELSE user_assignments.expires_at END
+                    FROM pools WHERE id = user_assignments.pool_id
+                )
+                WHERE email = ?
+                RETURNING username, pool_id, expires_at
+            ''', (email,)).fetchone()
+            if row is None:
+                return None
+
+        # Trigger changes count too: a new assignment changes three rows, a renewal one
+        inserted = conn.total_changes - changes > 1
+
+    if inserted:
+        assignments.add()
+    return row['username'], row['pool_id'], row['expires_at']
+
+def assign_users(emails, pool_id=None):
+    """Assign users to many emails in one transaction.
+
+    Returns {email: (status, username, pool name)} where status is 'assigned',
+    'existing' or 'full'. Emails must already be normalized, valid and unique.
+    Without a pool_id each new email goes to the least-loaded pool at that point.
+    """
+    results = {}
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+
+        # Emails that already have a slot keep it
+        for start in range(0, len(emails), BULK_QUERY_CHUNK):
+            chunk = emails[start:start + BULK_QUERY_CHUNK]
+            cursor.execute(f'''
+                SELECT user_assignments.email, user_assignments.username, pools.name, pools.lease_hours
+                FROM user_assignments JOIN pools ON pools.id = user_assignments.pool_id
+                WHERE user_assignments.email IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            rows = cursor.fetchall()
+            for row in rows:
+                results[row['email']] = ('existing', row['username'], row['name'])
+            # Listing an attendee again renews their lease, as signing up again does
+            cursor.executemany(
+                'UPDATE user_assignments SET expires_at = ? WHERE email = ?',
+                ((lease_expiry(row), row['email']) for row in rows if row['lease_hours'])
+            )
+
+        # Spread the rest over the pools with room, as single signups would
+        new_emails = [email for email in emails if email not in results]
+        if pool_id is None:
+            cursor.execute('SELECT * FROM pools WHERE active AND assigned < size')
+        else:
+            cursor.execute('SELECT * FROM pools WHERE id = ? AND active AND assigned < size', (pool_id,))
+        pools = {pool['id']: pool for pool in cursor.fetchall()}
+        heap = [(pool['assigned'] / pool['size'], pool['id'], pool['assigned']) for pool in pools.values()]
+        heapq.heapify(heap)
+        chosen = []
+        for _ in new_emails:
+            if not heap:
+                break
+            _, chosen_id, assigned = heapq.heappop(heap)
+            chosen.append(chosen_id)
+            assigned += 1
+            if assigned < pools[chosen_id]['size']:
+                heapq.heappush(heap, (assigned / pools[chosen_id]['size'], chosen_id, assigned))
+
+        # Each pool hands out its lowest free slots, in list order; inserting
+        # the assignments takes them off the free list (assignment_takes_slot)
+        numbers = {}
+        for chosen_id, wanted in Counter(chosen).items():
+            cursor.execute(
+                'SELECT number FROM free_slots WHERE pool_id = ? ORDER BY number LIMIT ?',
+                (chosen_id, wanted)
+            )
+            numbers[chosen_id] = iter([row['number'] for row in cursor.fetchall()])
+
+        new_rows = []
+        for email, chosen_id in zip(new_emails, chosen):
+            pool = pools[chosen_id]
+            number = next(numbers[chosen_id])
+            new_rows.append((email, chosen_id, number, f"{pool['username_prefix']}{number}", lease_expiry(pool)))
+        cursor.executemany(
+            'INSERT INTO user_assignments (email, pool_id, slot, username, expires_at) VALUES (?, ?, ?, ?, ?)',
+            new_rows
         )
-        conn.commit()
-        conn.close()
 
-        return username
-
-    except sqlite3.IntegrityError:
-        conn.close()
-        return None
+    for email, chosen_id, _, username, _ in new_rows:
+        results[email] = ('assigned', username, pools[chosen_id]['name'])
+    for email in new_emails[len(new_rows):]:
+        results[email] = ('full', None, None)
+    assignments.add(len(new_rows))
+    return results
+
+def release_assignments(condition, params=()):
+    """Delete the assignments matching an SQL condition and free their slots.
+
+    Works through them SWEEP_BATCH at a time, each batch in its own short
+    transaction, so signups keep going while a large release runs. Freed
+    slots go straight back on their pool's free list (assignment_frees_slot),
+    so the next signup can take them. Returns the released emails.
+    """
+    released = []
+    while True:
+        with db.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                DELETE FROM user_assignments
+                WHERE id IN (SELECT id FROM user_assignments WHERE {condition} LIMIT ?)
+                RETURNING email
+            ''', (*params, SWEEP_BATCH))
+            rows = cursor.fetchall()
+        released.extend(row['email'] for row in rows)
+        if len(rows) < SWEEP_BATCH:
+            break
+
+    if released:
+        assignments.load()
+    return released
+
+def sweep_expired():
+    """Release every assignment whose lease has expired; returns how many"""
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    # Checked with a read first, so a full event's signups don't queue for the write lock
+    with db.connection() as conn:
+        if conn.execute('SELECT 1 FROM user_assignments WHERE expires_at <= ? LIMIT 1', (now,)).fetchone() is None:
+            return 0
+    return len(release_assignments('expires_at <= ?', (now,)))
+
+def start_sweeper():
+    """Sweep expired leases every SWEEP_INTERVAL seconds in a background thread"""
+    def run():
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                released = sweep_expired()
+                if released:
+                    app.logger.info('Released %d expired assignments', released)
+            except Exception:
+                app.logger.exception('Sweeping expired assignments failed')
+
+    if SWEEP_INTERVAL > 0:
+        threading.Thread(target=run, name='lease-sweeper', daemon=True).start()
 
 @app.route('/')
 def index():
     """Render the main page"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) as count FROM user_assignments')
-    assigned_count = cursor.fetchone()['count']
-    conn.close()
-
-    return render_template('index.html',
-                         assigned_count=assigned_count,
-                         max_users=MAX_USERS)
+    global _page_cache
+    assigned_count = assignments.get()
+    capacity = assignments.capacity
+    key, page = _page_cache
+    if key != (assigned_count, capacity):
+        page = render_template('index.html',
+                               assigned_count=assigned_count,
+                               max_users=capacity)
+        _page_cache = ((assigned_count, capacity), page)
+
+    return page
+
+def too_many_requests(message, wait):
+    """429 response asking the client to come back in `wait` seconds"""
+    return jsonify({'error': message}), 429, {'Retry-After': str(math.ceil(wait))}
 
 @app.route('/signup', methods=['POST'])
 def signup():
     """Handle user signup"""
-    data = request.get_json()
-    email = data.get('email', '').strip().lower()
+    # Checked before anything else, so a client over its limit costs no database work
+    if signup_ip_limiter:
+        wait = signup_ip_limiter.hit(request.remote_addr)
+        if wait:
+            return too_many_requests('Too many signups from your network. Please wait a moment and try again.', wait)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    email = str(data.get('email') or '').strip().lower()
 
     if not email:
         return jsonify({'error': 'Email address is required'}), 400
@@ -119,126 +593,345 @@ def signup():
     if not validate_email(email):
         return jsonify({'error': 'Invalid email address format'}), 400
 
-    username = assign_user(email)
+    if signup_email_limiter:
+        wait = signup_email_limiter.hit(email)
+        if wait:
+            return too_many_requests('Too many signups for this email address. Please wait a moment and try again.', wait)
+
+    # A workshop link can name its pool; otherwise the least-loaded pool is used
+    pool_id = None
+    if data.get('pool'):
+        pool_id = assignments.pool_id(str(data['pool']))
+        if pool_id is None:
+            return jsonify({'error': 'Unknown workshop pool'}), 404
 
-    if username is None:
+    assignment = assign_user(email, pool_id)
+
+    # Leases that ran out since the last sweep are taken back before giving up
+    if assignment is None and sweep_expired():
+        assignment = assign_user(email, pool_id)
+
+    if assignment is None:
         return jsonify({'error': 'All users have been assigned. No more slots available.'}), 400
 
     # Prepare response with user credentials and instructions
-    response = {
-        'username': username,
-        'password': USER_PASSWORD,
-        'cluster_domain': CLUSTER_DOMAIN,
-        'lab_url': LAB_INSTRUCTIONS_URL,
-        'instructions': f'Access the lab instructions at {LAB_INSTRUCTIONS_URL} and use your credentials to log into the cluster.'
-    }
+    username, pool_id, expires_at = assignment
+    response = {**assignments.template(pool_id), 'username': username, 'expires_at': expires_at}
 
     return jsonify(response), 200
 
 @app.route('/stats')
 def stats():
     """Get current assignment statistics"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) as count FROM user_assignments')
-    assigned_count = cursor.fetchone()['count']
-    conn.close()
+    global _stats_cache
+    assigned_count = assignments.get()
+    capacity = assignments.capacity
+    key, body, etag = _stats_cache
+    if key != (assigned_count, capacity):
+        body = app.json.dumps({
+            'assigned': assigned_count,
+            'available': max(capacity - assigned_count, 0),
+            'total': capacity
+        })
+        etag = f'{assigned_count}-{capacity}'
+        _stats_cache = ((assigned_count, capacity), body, etag)
 
-    return jsonify({
-        'assigned': assigned_count,
-        'available': MAX_USERS - assigned_count,
-        'total': MAX_USERS
-    })
+    # The browser polls this; an unchanged count is answered with 304
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
 
-@app.route('/admin/users')
-def admin_users():
-    """Admin endpoint to list all registered users (requires authentication)"""
-    # Check for admin token in header
+def get_admin_token():
+    """Admin token from the Authorization header or the token query parameter"""
     auth_header = request.headers.get('Authorization')
-    token = request.args.get('token')
-
-    # Accept token from either Authorization header or query parameter
-    provided_token = None
     if auth_header and auth_header.startswith('Bearer '):
-        provided_token = auth_header[7:]
-    elif token:
-        provided_token = token
+        return auth_header[7:]
+    return request.args.get('token')
+
+def admin_auth_error():
+    """Error response unless the request carries the admin token, else None"""
+    # The token can come in a URL, where it is easy to guess at quickly:
+    # an IP that keeps sending wrong tokens is locked out for a while
+    ip = request.remote_addr
+    if admin_failure_limiter:
+        wait = admin_failure_limiter.blocked(ip)
+        if wait:
+            return too_many_requests('Too many failed admin logins. Try again later.', wait)
+
+    token = get_admin_token()
+    # Compared in constant time, so response timing says nothing about the token
+    if token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return None
 
-    if provided_token != ADMIN_TOKEN:
-        return jsonify({'error': 'Unauthorized. Valid admin token required.'}), 401
+    if admin_failure_limiter:
+        admin_failure_limiter.hit(ip)
+    return jsonify({'error': 'Unauthorized. Valid admin token required.'}), 401
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, email, username, assigned_at
-        FROM user_assignments
-        ORDER BY assigned_at DESC
-    ''')
-    users = cursor.fetchall()
-    conn.close()
+@app.route('/admin/users')
+def admin_users():
+    """Admin endpoint to list all registered users (requires authentication)"""
+    error = admin_auth_error()
+    if error:
+        return error
 
-    # Convert to list of dicts
-    users_list = []
-    for user in users:
-        users_list.append({
+    # Keyset pagination, newest first: pass the returned next_after to get the next page
+    try:
+        limit = min(int(request.args.get('limit', ADMIN_PAGE_SIZE)), ADMIN_MAX_PAGE_SIZE)
+        after = int(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return jsonify({'error': 'limit and after must be integers'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    conditions = []
+    params = []
+    if request.args.get('email'):
+        escaped = request.args['email'].lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("email LIKE ? ESCAPE '\\'")
+        params.append(f'%{escaped}%')
+    if request.args.get('username'):
+        conditions.append('username = ?')
+        params.append(request.args['username'])
+    if request.args.get('pool'):
+        conditions.append('pools.name = ?')
+        params.append(request.args['pool'])
+    if request.args.get('since'):
+        conditions.append('assigned_at >= ?')
+        params.append(request.args['since'])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    # A page only adds the keyset condition, so total counts exactly the rows paged through
+    page_conditions = conditions + ['user_assignments.id < ?'] if after is not None else conditions
+    page_params = params + [after] if after is not None else params
+    page_where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ''
+
+    with db.connection() as conn:
+        total = conn.execute(f'''
+            SELECT COUNT(*)
+            FROM user_assignments JOIN pools ON pools.id = user_assignments.pool_id
+            {where}
+        ''', params).fetchone()[0]
+        users = conn.execute(f'''
+            SELECT user_assignments.id, email, username, pools.name AS pool, assigned_at, expires_at
+            FROM user_assignments JOIN pools ON pools.id = user_assignments.pool_id
+            {page_where}
+            ORDER BY user_assignments.id DESC
+            LIMIT ?
+        ''', (*page_params, limit)).fetchall()
+        pools = conn.execute('SELECT * FROM pools ORDER BY id').fetchall()
+
+    users_list = [
+        {
             'id': user['id'],
             'email': user['email'],
             'username': user['username'],
+            'pool': user['pool'],
             'assigned_at': user['assigned_at'],
-            'password': USER_PASSWORD,
-            'cluster_domain': CLUSTER_DOMAIN
-        })
+            'expires_at': user['expires_at']
+        }
+        for user in users
+    ]
 
     return jsonify({
-        'total': len(users_list),
+        'total': total,
+        'count': len(users_list),
+        'next_after': users_list[-1]['id'] if len(users_list) == limit else None,
         'users': users_list,
-        'config': {
-            'max_users': MAX_USERS,
-            'cluster_domain': CLUSTER_DOMAIN,
-            'password': USER_PASSWORD,
-            'lab_url': LAB_INSTRUCTIONS_URL
-        }
+        # Shared by every user of a pool, so listed once per pool rather than per entry
+        'pools': {pool['name']: pool_info(pool) for pool in pools}
     })
 
+def pool_info(pool):
+    """API view of a pools row"""
+    return {
+        'size': pool['size'],
+        'assigned': pool['assigned'],
+        'active': bool(pool['active']),
+        'cluster_domain': pool['cluster_domain'],
+        'password': pool['password'],
+        'username_prefix': pool['username_prefix'],
+        'lab_url': pool['lab_url'],
+        'lease_hours': pool['lease_hours']
+    }
+
+@app.route('/admin/pools', methods=['GET', 'POST'])
+def admin_pools():
+    """Admin endpoint to list slot pools, or create or update one (requires authentication)"""
+    error = admin_auth_error()
+    if error:
+        return error
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not data.get('name'):
+            return jsonify({'error': 'Send the pool as a JSON object with at least a name'}), 400
+        with db.transaction() as conn:
+            cursor = conn.cursor()
+            # Fields left out of an update keep their current values
+            cursor.execute('SELECT * FROM pools WHERE name = ?', (str(data['name']).strip(),))
+            current = cursor.fetchone()
+            try:
+                save_pool(cursor, pool_settings({**(dict(current) if current else {}), **data}))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        assignments.load()
+
+    with db.connection() as conn:
+        pools = conn.execute('SELECT * FROM pools ORDER BY id').fetchall()
+    return jsonify({'pools': {pool['name']: pool_info(pool) for pool in pools}})
+
 @app.route('/admin/export')
 def admin_export():
     """Admin endpoint to export users as CSV (requires authentication)"""
-    # Check for admin token
-    auth_header = request.headers.get('Authorization')
-    token = request.args.get('token')
-
-    provided_token = None
-    if auth_header and auth_header.startswith('Bearer '):
-        provided_token = auth_header[7:]
-    elif token:
-        provided_token = token
-
-    if provided_token != ADMIN_TOKEN:
-        return jsonify({'error': 'Unauthorized. Valid admin token required.'}), 401
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT email, username, assigned_at
-        FROM user_assignments
-        ORDER BY username
-    ''')
-    users = cursor.fetchall()
-    conn.close()
-
-    # Generate CSV
-    csv_lines = ['Email,Username,Password,Cluster Domain,Assigned At']
-    for user in users:
-        csv_lines.append(f"{user['email']},{user['username']},{USER_PASSWORD},{CLUSTER_DOMAIN},{user['assigned_at']}")
-
-    csv_content = '\n'.join(csv_lines)
+    error = admin_auth_error()
+    if error:
+        return error
+
+    def generate():
+        # Rows are read in batches and sent as they are written, so memory
+        # use doesn't grow with the table; csv quotes commas and quotes
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(['Email', 'Username', 'Password', 'Cluster Domain', 'Assigned At', 'Pool', 'Expires At'])
+        with db.connection() as conn:
+            # Ordered by pool, then slot number, following the (pool_id, slot) index
+            cursor = conn.execute('''
+                SELECT email, username, password, cluster_domain, assigned_at, name, expires_at
+                FROM user_assignments JOIN pools ON pools.id = user_assignments.pool_id
+                ORDER BY pool_id, slot
+            ''')
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_ROWS)
+                if not rows:
+                    break
+                writer.writerows(
+                    (user['email'], user['username'], user['password'], user['cluster_domain'],
+                     user['assigned_at'], user['name'], user['expires_at'])
+                    for user in rows
+                )
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
 
     return Response(
-        csv_content,
+        generate(),
         mimetype='text/csv',
         headers={'Content-Disposition': 'attachment; filename=lab-users.csv'}
     )
 
+def read_email_list():
+    """Emails from a JSON body {"emails": [...]}, or a CSV/text body or file upload.
+
+    CSV input uses the Email column when there is a header row, otherwise
+    the first column. Returns None for a malformed JSON body.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True)
+        emails = data.get('emails') if isinstance(data, dict) else None
+        if not isinstance(emails, list):
+            return None
+        return [str(email) for email in emails]
+
+    upload = request.files.get('file')
+    text = upload.read().decode('utf-8-sig') if upload else request.get_data(as_text=True)
+    # The header is the first non-empty line; rows are then kept or dropped
+    # by the email column alone, so a blank Name column doesn't lose anyone
+    rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+    header = [cell.strip().lower() for cell in rows[0]] if rows else []
+    if 'email' in header:
+        column = header.index('email')
+        rows = rows[1:]
+    else:
+        column = 0
+    return [row[column] for row in rows if column < len(row) and row[column].strip()]
+
+@app.route('/admin/preregister', methods=['POST'])
+def admin_preregister():
+    """Admin endpoint to assign users to a list of emails at once (requires authentication)"""
+    error = admin_auth_error()
+    if error:
+        return error
+
+    raw_emails = read_email_list()
+    if raw_emails is None:
+        return jsonify({'error': 'Send {"emails": [...]} as JSON, or a CSV of emails'}), 400
+    if len(raw_emails) > BULK_MAX_EMAILS:
+        return jsonify({'error': f'At most {BULK_MAX_EMAILS} emails per request'}), 413
+
+    pool_id = None
+    if request.args.get('pool'):
+        pool_id = assignments.pool_id(request.args['pool'])
+        if pool_id is None:
+            return jsonify({'error': 'Unknown workshop pool'}), 404
+
+    # Normalize like /signup; an email listed twice is assigned once
+    emails = []
+    seen = set()
+    invalid = []
+    for raw in raw_emails:
+        email = raw.strip().lower()
+        if not validate_email(email):
+            invalid.append(raw)
+        elif email not in seen:
+            seen.add(email)
+            emails.append(email)
+
+    results = assign_users(emails, pool_id) if emails else {}
+
+    summary = {'assigned': 0, 'existing': 0, 'full': 0, 'invalid': len(invalid)}
+    entries = []
+    for email in emails:
+        status, username, pool_name = results[email]
+        summary[status] += 1
+        entries.append({'email': email, 'status': status, 'username': username, 'pool': pool_name})
+    entries.extend({'email': raw, 'status': 'invalid', 'username': None, 'pool': None} for raw in invalid)
+
+    return jsonify({'summary': summary, 'results': entries})
+
+@app.route('/admin/release', methods=['POST'])
+def admin_release():
+    """Admin endpoint to free the slots of a list of emails, or of everyone (requires authentication)"""
+    error = admin_auth_error()
+    if error:
+        return error
+
+    conditions = []
+    params = []
+    if request.args.get('pool'):
+        pool_id = assignments.pool_id(request.args['pool'])
+        if pool_id is None:
+            return jsonify({'error': 'Unknown workshop pool'}), 404
+        conditions.append('pool_id = ?')
+        params.append(pool_id)
+
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict) and data.get('all') is True:
+        released = release_assignments(' AND '.join(conditions) or '1', params)
+        return jsonify({'released': len(released), 'not_found': []})
+
+    raw_emails = read_email_list()
+    if raw_emails is None:
+        return jsonify({'error': 'Send {"emails": [...]} or {"all": true} as JSON, or a CSV of emails'}), 400
+    if len(raw_emails) > BULK_MAX_EMAILS:
+        return jsonify({'error': f'At most {BULK_MAX_EMAILS} emails per request'}), 413
+
+    emails = list(dict.fromkeys(raw.strip().lower() for raw in raw_emails if raw.strip()))
+    released = set()
+    for start in range(0, len(emails), BULK_QUERY_CHUNK):
+        chunk = emails[start:start + BULK_QUERY_CHUNK]
+        released.update(release_assignments(
+            ' AND '.join([*conditions, f"email IN ({','.join('?' * len(chunk))})"]),
+            (*params, *chunk)
+        ))
+
+    return jsonify({
+        'released': len(released),
+        'not_found': [email for email in emails if email not in released]
+    })
+
 if __name__ == '__main__':
     init_db()
+    start_sweeper()
     app.run(host='0.0.0.0', port=8080, debug=os.getenv('FLASK_DEBUG', 'False') == 'True')
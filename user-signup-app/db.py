@@ -0,0 +1,83 @@
+"""
+SQLite access for the user signup app.
+
+Connections are opened once and reused from a small pool instead of per
+request, which also keeps each connection's prepared statement cache warm.
+The database runs in WAL mode, so page views and /stats read while a signup
+writes, and with synchronous=NORMAL a commit no longer waits for an fsync
+(a committed signup survives an app crash; only a power loss can drop the
+last few). Writers wait up to the busy timeout for the lock instead of
+failing.
+"""
+
+import os
+import queue
+import sqlite3
+from contextlib import contextmanager
+
+
+class Database:
+    """A pool of configured connections to one SQLite file"""
+
+    def __init__(self, path, pool_size=8, busy_timeout=5.0, synchronous='NORMAL'):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._pid = os.getpid()
+
+    def _connect(self):
+        # Autocommit mode: transactions are only the explicit ones in transaction()
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; it goes back to the pool afterwards"""
+        if self._pid != os.getpid():
+            # Forked worker: connections opened by the parent must not be shared
+            self._pool = queue.LifoQueue(maxsize=self.pool_size)
+            self._pid = os.getpid()
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection holding the write lock; commits unless an exception escapes"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def close(self):
+        """Close the pooled connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,43 @@
+"""
+Gunicorn settings for serving the user signup app in production.
+
+    gunicorn app:app
+
+Gunicorn reads this file from the working directory. Each worker process
+serves requests from a pool of threads (the gthread worker), so a signup
+waiting on the database blocks only its own thread while the others keep
+answering page views and /stats. Several workers are safe with SQLite: every
+slot claim runs in a BEGIN IMMEDIATE transaction, so workers take turns on
+the write lock, and each worker's in-memory count is re-read from the
+database every STATS_CACHE_TTL seconds.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+# Worker processes; by default the CPUs this process may run on
+cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+workers = int(os.getenv('WEB_CONCURRENCY', cpus))
+worker_class = 'gthread'
+# Threads per worker, i.e. requests each worker handles at once
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# Let a whole room's signups connect at once instead of retrying
+backlog = 2048
+timeout = 30
+accesslog = '-' if os.getenv('ACCESS_LOG', 'False') == 'True' else None
+
+
+def on_starting(server):
+    # The app splits its rate limits between the workers, however their number was set
+    os.environ['WEB_CONCURRENCY'] = str(server.cfg.workers)
+    # Create or migrate the schema once, in the master, before any worker starts
+    import app
+    app.init_db()
+    # Workers open their own connections; don't hand them the master's
+    app.db.close()
+
+
+def post_worker_init(worker):
+    # Every worker sweeps; concurrent sweeps simply find nothing left to release
+    import app
+    app.start_sweeper()
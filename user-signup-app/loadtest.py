@@ -0,0 +1,358 @@
+"""
+Signup burst test and throughput benchmark for the user signup app.
+
+The burst mode fires a number of simultaneous /signup requests, all released
+at the same instant, and checks the outcome: every slot handed out exactly
+once, the lowest slots first, and no "no more slots" answer while slots
+remain. The throughput mode keeps --concurrency clients busy with signups,
+then with /stats, then with the landing page, and reports requests/second and
+latency percentiles for each.
+
+    # Start the app on a throwaway database with 500 slots, then burst it
+    python loadtest.py --signups 500
+
+    # More signups than slots: exactly MAX_USERS succeed, the rest are full
+    python loadtest.py --signups 500 --slots 25
+
+    # Against a running instance (it must have an empty database, and a
+    # SIGNUP_IP_BURST of 0 or at least the number of signups)
+    python loadtest.py --url http://localhost:8080 --signups 50 --slots 25
+
+    # Throughput: 2000 signups, /stats calls and page views from 16 clients
+    python loadtest.py --mode throughput --requests 2000 --concurrency 16
+
+    # The same under gunicorn (gunicorn.conf.py), pinned to one core, then four
+    python loadtest.py --mode throughput --server gunicorn --cores 1 4
+
+    # Cost of one signup inside the app: microseconds, SQL statements, hot spots
+    python loadtest.py --mode profile --requests 5000
+
+The local app keeps its temporary database in --db-dir; use a directory on
+the same kind of disk as production, since fsync cost dominates writes. With
+--server gunicorn the load generator runs on the CPUs not given to the app,
+when there are any left. Every request comes from one address, so the local
+app runs without the per-IP signup limit; the profile mode keeps it on, with
+room for every request, to include its cost.
+
+Only the standard library is used, so it runs wherever the app does (the
+gunicorn server mode needs gunicorn installed, as in production).
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import pstats
+import socket
+import cProfile
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def post_signup(url, email, timeout=60):
+    """POST one signup; returns (status, body)"""
+    request = urllib.request.Request(
+        f'{url}/signup',
+        data=json.dumps({'email': email}).encode(),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        try:
+            return e.code, json.loads(body)
+        except ValueError:
+            return e.code, {'error': body.decode(errors='replace')}
+
+
+def get_page(url, path, timeout=60):
+    """GET a page; returns (status, raw body)"""
+    with urllib.request.urlopen(f'{url}{path}', timeout=timeout) as response:
+        return response.status, response.read()
+
+
+def load_app(slots, db_dir=None, ip_burst=0):
+    """Import the app on a temporary database with `slots` slots; returns the module"""
+    directory = tempfile.mkdtemp(prefix='signup-loadtest-', dir=db_dir)
+    os.environ['DB_PATH'] = os.path.join(directory, 'users.db')
+    os.environ['MAX_USERS'] = str(slots)
+    os.environ['SIGNUP_IP_BURST'] = str(ip_burst)
+
+    import app as signup_app
+
+    signup_app.init_db()
+    return signup_app
+
+
+def start_local_server(slots, port=0, db_dir=None):
+    """Run the app on a temporary database in a background thread; returns its URL"""
+    from werkzeug.serving import make_server
+
+    signup_app = load_app(slots, db_dir)
+    # Per-request log lines would cost more than the requests being measured
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', port, signup_app.app, threaded=True)
+    # Let the whole burst connect at once instead of retrying SYNs
+    server.socket.listen(1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def start_gunicorn_server(slots, cores, db_dir=None):
+    """Run the app under gunicorn on a temporary database, pinned to `cores` CPUs.
+
+    Uses one worker per core. Returns (url, process, cpus).
+    """
+    directory = tempfile.mkdtemp(prefix='signup-loadtest-', dir=db_dir)
+    cpus = sorted(os.sched_getaffinity(0))[:cores]
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    env = dict(
+        os.environ,
+        DB_PATH=os.path.join(directory, 'users.db'),
+        MAX_USERS=str(slots),
+        SIGNUP_IP_BURST='0',
+        WEB_CONCURRENCY=str(len(cpus)),
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        preexec_fn=lambda: os.sched_setaffinity(0, cpus)
+    )
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            get_page(url, '/stats', timeout=1)
+            return url, process, cpus
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.2)
+
+
+def run_throughput(url, requests, concurrency):
+    """Signup, /stats and landing page phases against url; prints one line per phase"""
+    phases = (
+        ('signup', lambda i: post_signup(url, f'bench{i}@example.com')),
+        ('stats', lambda i: get_page(url, '/stats')),
+        ('index', lambda i: get_page(url, '/')),
+    )
+    for name, call in phases:
+        result = throughput(call, requests, concurrency)
+        print(f'{name:>7}: {result["per_second"]:7.0f} req/s  p50 {result["p50_ms"]:6.1f} ms  '
+              f'p99 {result["p99_ms"]:6.1f} ms  errors {result["errors"]}')
+
+
+def profile_signups(count, db_dir=None):
+    """Time `count` new signups and `count` repeated ones in-process, without HTTP.
+
+    Prints microseconds and SQL statements per signup, the part of it spent
+    on rate limiting, then the functions that take the most time for new
+    signups.
+    """
+    from werkzeug.test import EnvironBuilder
+
+    signup_app = load_app(2 * count, db_dir, ip_burst=10 * count)
+    client = signup_app.app.test_client()
+    client.post('/signup', json={'email': 'warmup@example.com'})
+
+    statements = []
+
+    def trace(sql):
+        # Trigger programs are reported again under their statement's text
+        if not statements or statements[-1] != sql:
+            statements.append(sql)
+
+    # Requests are served one at a time, so they all reuse this pooled connection
+    with signup_app.db.connection() as conn:
+        conn.set_trace_callback(trace)
+
+    def run(label, emails, profiler=None):
+        # WSGI environs are built beforehand, so only the app itself is timed
+        environs = [
+            EnvironBuilder(path='/signup', method='POST', json={'email': email}).get_environ()
+            for email in emails
+        ]
+        statements.clear()
+        started = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        for environ in environs:
+            b''.join(signup_app.app.wsgi_app(environ, lambda status, headers: None))
+        if profiler:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+        print(f'{label:>9}: {elapsed / len(emails) * 1e6:7.1f} us/signup  '
+              f'{len(statements) / len(emails):.1f} SQL statements/signup')
+
+    emails = [f'profile{i}@example.com' for i in range(count)]
+    run('new', emails)
+    run('repeated', emails)
+
+    # Both limits as /signup checks them, on buckets that already exist
+    started = time.perf_counter()
+    for email in emails:
+        signup_app.signup_ip_limiter.hit('127.0.0.1')
+        signup_app.signup_email_limiter.hit(email)
+    elapsed = time.perf_counter() - started
+    print(f'{"limits":>9}: {elapsed / len(emails) * 1e6:7.1f} us/signup')
+
+    # Free the slots again so the profiled signups are new ones too
+    client.post('/admin/release', json={'all': True},
+                headers={'Authorization': f'Bearer {signup_app.ADMIN_TOKEN}'})
+    profiler = cProfile.Profile()
+    run('profiled', emails, profiler)
+    pstats.Stats(profiler, stream=sys.stdout).sort_stats('tottime').print_stats(12)
+
+
+def burst(url, emails):
+    """Send all signups simultaneously; returns [(email, status, body, seconds)]"""
+    barrier = threading.Barrier(len(emails))
+
+    def signup(email):
+        barrier.wait()
+        started = time.perf_counter()
+        status, body = post_signup(url, email)
+        return email, status, body, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=len(emails)) as pool:
+        return list(pool.map(signup, emails))
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def throughput(call, count, concurrency):
+    """Run call(i) for i in range(count) from `concurrency` threads; returns a summary"""
+    latencies = []
+    errors = 0
+
+    def run(i):
+        started = time.perf_counter()
+        status, _ = call(i)
+        return status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for status, seconds in pool.map(run, range(count)):
+            latencies.append(seconds)
+            errors += status != 200
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': count,
+        'errors': errors,
+        'per_second': count / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def check(results, slots):
+    """List of problems with a burst's outcome (empty when correct)"""
+    problems = []
+    assigned = [body['username'] for _, status, body, _ in results if status == 200]
+    full = [body for _, status, body, _ in results if status == 400 and 'No more slots' in body.get('error', '')]
+    other = [(status, body) for _, status, body, _ in results if status != 200 and body not in full]
+
+    expected = min(slots, len(results))
+    if len(assigned) != expected:
+        problems.append(f'{len(assigned)} signups succeeded, expected {expected}')
+    if len(set(assigned)) != len(assigned):
+        problems.append(f'{len(assigned) - len(set(assigned))} usernames were handed out twice')
+    if set(assigned) != {f'user{i}' for i in range(1, expected + 1)}:
+        problems.append('assigned usernames are not the lowest slots user1..user%d' % expected)
+    if other:
+        problems.append(f'{len(other)} unexpected responses, e.g. {other[0]}')
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrent signup burst test and throughput benchmark')
+    parser.add_argument('--mode', choices=('burst', 'throughput', 'profile'), default='burst')
+    parser.add_argument('--url', help='running app to test (default: start one on a temporary database)')
+    parser.add_argument('--db-dir', help='directory for the local app\'s temporary database')
+    parser.add_argument('--signups', type=int, default=500, help='simultaneous signups (burst)')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per phase (throughput, profile)')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients (throughput)')
+    parser.add_argument('--slots', type=int, help='MAX_USERS of the app (default: enough for every signup)')
+    parser.add_argument('--server', choices=('dev', 'gunicorn'), default='dev',
+                        help='local app server: Werkzeug in this process, or gunicorn with gunicorn.conf.py')
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, 4],
+                        help='CPUs to pin gunicorn to, one run per value (throughput)')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'profile':
+        profile_signups(args.requests, args.db_dir)
+        return 0
+
+    if args.mode == 'throughput' and args.server == 'gunicorn' and not args.url:
+        available = os.sched_getaffinity(0)
+        for cores in args.cores:
+            url, process, cpus = start_gunicorn_server(args.slots or args.requests, cores, args.db_dir)
+            # Keep the load generator off the app's CPUs where possible
+            os.sched_setaffinity(0, (available - set(cpus)) or available)
+            note = '' if len(cpus) == cores else f' (only {len(cpus)} available)'
+            print(f'gunicorn, {len(cpus)} core(s), {len(cpus)} worker(s){note}:')
+            try:
+                run_throughput(url, args.requests, args.concurrency)
+            finally:
+                process.terminate()
+                process.wait()
+                os.sched_setaffinity(0, available)
+        return 0
+
+    if args.mode == 'throughput':
+        url = args.url or start_local_server(args.slots or args.requests, db_dir=args.db_dir)
+        run_throughput(url, args.requests, args.concurrency)
+        return 0
+
+    slots = args.slots or args.signups
+    process = None
+    if args.url:
+        url = args.url
+    elif args.server == 'gunicorn':
+        # Several workers racing for the same slots, on the largest --cores
+        url, process, _ = start_gunicorn_server(slots, max(args.cores), args.db_dir)
+    else:
+        url = start_local_server(slots, db_dir=args.db_dir)
+    emails = [f'attendee{i}@example.com' for i in range(args.signups)]
+
+    started = time.perf_counter()
+    try:
+        results = burst(url, emails)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds for _, _, _, seconds in results)
+    print(f'{len(results)} simultaneous signups for {slots} slots in {elapsed:.2f}s '
+          f'({len(results) / elapsed:.0f}/s, max latency {latencies[-1] * 1000:.0f} ms)')
+    problems = check(results, slots)
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    if not problems:
+        print('OK: every slot assigned exactly once, lowest first, no false "full" errors')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
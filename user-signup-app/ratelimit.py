@@ -0,0 +1,66 @@
+"""
+In-memory token buckets for rate limiting the user signup app.
+
+Each key (a client IP, an email address) has a bucket that holds up to
+`burst` tokens and refills at `rate` tokens per second; a request spends one.
+Buckets live in an LRU-ordered dict capped at `max_keys`, so memory stays
+bounded however many clients show up: the least recently seen key is dropped
+first, and a dropped key simply starts again with a full bucket. Every check
+is a dict lookup and a little arithmetic, whatever the number of keys.
+
+Limits are per process; the app divides them between its worker processes.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """Token buckets for up to `max_keys` keys, least recently used evicted first"""
+
+    def __init__(self, burst, rate, max_keys=10000):
+        # A bucket that never refills would lock a client out for good
+        if rate <= 0:
+            raise ValueError(f'Rate limit refill rate must be positive, got {rate}')
+        self.burst = float(burst)
+        self.rate = float(rate)
+        self.max_keys = max_keys
+        # key -> [tokens, monotonic time of the last update]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _refill(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def _wait(self, tokens):
+        """Seconds until a bucket holding `tokens` has one to spend"""
+        return (1 - tokens) / self.rate
+
+    def hit(self, key):
+        """Spend a token for key; returns 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._refill(key, now)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return self._wait(bucket[0])
+
+    def blocked(self, key):
+        """Seconds until key may spend a token, 0 if it may now; spends nothing"""
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._buckets:
+                return 0
+            bucket = self._refill(key, now)
+            return 0 if bucket[0] >= 1 else self._wait(bucket[0])